@@ -23,8 +23,12 @@ DROP FUNCTION IF EXISTS altimetry2;
 DROP FUNCTION IF EXISTS ref_to_string;
 DROP FUNCTION IF EXISTS refs_to_string;
 DROP FUNCTION IF EXISTS add_refs;
+DROP FUNCTION IF EXISTS merge_refs;
 DROP FUNCTION IF EXISTS array_distinct;
 DROP FUNCTION IF EXISTS natsort;
+DROP FUNCTION IF EXISTS update_way_relation_closure;
+DROP FUNCTION IF EXISTS in_area;
+DROP FUNCTION IF EXISTS build_areas;
 
 CREATE FUNCTION natsort (text) RETURNS text[] AS
 $$
@@ -40,32 +44,39 @@ $$
       CASE WHEN $1 = '' THEN NULL ELSE $1 END, E'(\\D+)|(\\d+)', 'g'
     ) AS match_array
   ) AS a
-$$ LANGUAGE sql IMMUTABLE;
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
 
 CREATE FUNCTION array_distinct(anyarray) RETURNS anyarray AS $$
   SELECT array_agg(DISTINCT x) FROM unnest($1) t(x);
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 CREATE FUNCTION ref_to_string(TEXT) RETURNS TEXT AS $$
   SELECT array_to_string (array_agg (x ORDER BY natsort (x)), ' - ')
     FROM unnest(array_distinct (string_to_array ($1, ';'))) t(x);
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 CREATE FUNCTION add_refs(TEXT [], TEXT) RETURNS TEXT[] AS $$
   -- SELECT $1 || string_to_array (regexp_replace ($2, 'AV(\d+)', '\1⃤'), ';');
   SELECT $1 || string_to_array ($2, ';');
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+-- combines the partial states of two parallel workers
+CREATE FUNCTION merge_refs(TEXT [], TEXT []) RETURNS TEXT[] AS $$
+  SELECT $1 || $2;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 CREATE FUNCTION refs_to_string(TEXT[]) RETURNS TEXT AS $$
   SELECT array_to_string (array_agg (x ORDER BY natsort (x)), ' - ')
     FROM unnest(array_distinct ($1)) t(x);
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 CREATE AGGREGATE ref_agg (TEXT) (
   sfunc = add_refs,
   stype = TEXT[],
   initcond = '{}',
-  finalfunc = refs_to_string
+  combinefunc = merge_refs,
+  finalfunc = refs_to_string,
+  parallel = safe
 );
 
 ALTER TABLE planet_osm_line ADD COLUMN IF NOT EXISTS route_refs TEXT;
@@ -122,41 +133,150 @@ FROM snapshot.relation_members mn
     JOIN snapshot.relations r ON mn.relation_id = r.id;
 
 
-CREATE VIEW all_routes_view AS
-WITH RECURSIVE all_routes (way_id, rel_id, rel_tags) AS (
-    -- select all lines in some relation
-    SELECT line.osm_id AS way_id, r.id AS rel_id, r.tags AS rel_tags
-    FROM planet_osm_line line
-      JOIN relations_of r ON r.member_id = line.osm_id
-  UNION
-    -- add all super relations
-    SELECT ar.way_id, r.id AS rel_id, r.tags AS rel_tags
-    FROM all_routes ar
-      JOIN relations_of r ON r.member_id = ar.rel_id
-)
-SELECT way_id,
-       ref_agg (rel_tags->'ref') AS refs,
-       ref_agg (rel_tags->'name') AS names,
-       array_agg (rel_id ORDER BY rel_id) AS rel_ids
-FROM all_routes ar
-WHERE rel_tags->'route' IN  ('foot', 'hiking') -- , 'bicycle', 'mtb', 'piste', 'bus')
-GROUP BY way_id;
+-- every way with every relation it is in, directly or through super relations
+CREATE TABLE IF NOT EXISTS snapshot.way_relation_closure (
+  way_id BIGINT NOT NULL,
+  rel_id BIGINT NOT NULL,
+  PRIMARY KEY (way_id, rel_id)
+);
 
-CREATE VIEW snapshot.way_super_routes_view AS
-WITH RECURSIVE super_routes (way_id, relation_id) AS (
-    -- selects lines that are in some relation
-    SELECT w.id AS way_id, rm.*
-    FROM snapshot.ways w
-      JOIN snapshot.relation_members rm
-        ON (rm.member_id, rm.member_type) = (w.id, 'W')
+CREATE INDEX IF NOT EXISTS way_relation_closure_rel_id_idx
+  ON snapshot.way_relation_closure (rel_id, way_id);
+
+TRUNCATE snapshot.way_relation_closure;
+
+INSERT INTO snapshot.way_relation_closure (way_id, rel_id)
+WITH RECURSIVE closure (way_id, rel_id) AS (
+    -- all ways in some relation
+    SELECT rm.member_id, rm.relation_id
+    FROM snapshot.relation_members rm
+    WHERE rm.member_type = 'W'
   UNION
     -- add all super relations
-    SELECT sr.way_id, rm.*
-    FROM super_routes sr
+    SELECT c.way_id, rm.relation_id
+    FROM closure c
       JOIN snapshot.relation_members rm
-        ON (rm.member_id, rm.member_type) = (sr.relation_id, 'R')
+        ON (rm.member_id, rm.member_type) = (c.rel_id, 'R')
 )
-SELECT * FROM super_routes;
+SELECT way_id, rel_id FROM closure;
+
+ANALYZE snapshot.way_relation_closure;
+
+-- update the closure after the relations in $1 were created, modified or
+-- deleted.  this also updates all their super relations.
+CREATE FUNCTION update_way_relation_closure (BIGINT[]) RETURNS VOID AS $$
+DECLARE
+  affected BIGINT[];
+BEGIN
+  WITH RECURSIVE super_relations (rel_id) AS (
+      SELECT unnest ($1)
+    UNION
+      SELECT rm.relation_id
+      FROM super_relations sr
+        JOIN snapshot.relation_members rm
+          ON (rm.member_id, rm.member_type) = (sr.rel_id, 'R')
+  )
+  SELECT array_agg (rel_id) INTO affected FROM super_relations;
+
+  DELETE FROM snapshot.way_relation_closure WHERE rel_id = ANY (affected);
+
+  INSERT INTO snapshot.way_relation_closure (way_id, rel_id)
+  WITH RECURSIVE sub_members (rel_id, member_id, member_type) AS (
+      SELECT rm.relation_id, rm.member_id, rm.member_type
+      FROM snapshot.relation_members rm
+      WHERE rm.relation_id = ANY (affected)
+    UNION
+      -- descend into sub relations
+      SELECT sm.rel_id, rm.member_id, rm.member_type
+      FROM sub_members sm
+        JOIN snapshot.relation_members rm
+          ON rm.relation_id = sm.member_id
+      WHERE sm.member_type = 'R'
+  )
+  SELECT DISTINCT member_id, rel_id
+  FROM sub_members
+  WHERE member_type = 'W'
+  ON CONFLICT DO NOTHING;
+END;
+$$ LANGUAGE plpgsql;
+
+-- osmosis calls this after applying a change with --write-pgsql-change
+CREATE OR REPLACE FUNCTION snapshot.osmosisUpdate () RETURNS VOID AS $$
+  SELECT update_way_relation_closure (array_agg (id))
+  FROM snapshot.actions
+  WHERE data_type = 'R';
+$$ LANGUAGE SQL;
+
+
+-- the polygons of the admin areas we check, built on demand by build_areas ()
+CREATE TABLE IF NOT EXISTS snapshot.areas (
+  area_id BIGINT PRIMARY KEY,
+  version INT,
+  geom    GEOMETRY (MultiPolygon, 4326)
+);
+
+-- the same polygons subdivided into small parts for fast spatial joins
+CREATE TABLE IF NOT EXISTS snapshot.area_parts (
+  area_id BIGINT NOT NULL,
+  geom    GEOMETRY (Polygon, 4326)
+);
+
+CREATE INDEX IF NOT EXISTS area_parts_area_id_idx ON snapshot.area_parts (area_id);
+CREATE INDEX IF NOT EXISTS area_parts_geom_idx    ON snapshot.area_parts USING GIST (geom);
+
+-- the snapshot may have changed
+TRUNCATE snapshot.areas, snapshot.area_parts;
+
+-- build the polygons of the area relations in $1 from their member ways
+CREATE FUNCTION build_areas (BIGINT[]) RETURNS VOID AS $$
+BEGIN
+  DELETE FROM snapshot.areas      WHERE area_id = ANY ($1);
+  DELETE FROM snapshot.area_parts WHERE area_id = ANY ($1);
+
+  INSERT INTO snapshot.areas (area_id, version, geom)
+  SELECT r.id, r.version, ST_Multi (ST_BuildArea (ST_Collect (w.linestring)))
+  FROM snapshot.relations r
+    JOIN snapshot.relation_members rm ON (rm.relation_id, rm.member_type) = (r.id, 'W')
+    JOIN snapshot.ways w ON w.id = rm.member_id
+  WHERE r.id = ANY ($1) AND rm.member_role IN ('outer', 'inner')
+  GROUP BY r.id, r.version;
+
+  INSERT INTO snapshot.area_parts (area_id, geom)
+  SELECT area_id, ST_Subdivide (geom, 256)
+  FROM snapshot.areas
+  WHERE area_id = ANY ($1);
+
+  ANALYZE snapshot.area_parts;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the parts of the areas in $1.  use like:
+--   WHERE EXISTS (SELECT 1 FROM in_area (:areas) a WHERE ST_Intersects (a.geom, w.linestring))
+-- the planner inlines this function, so the GiST indices get used.
+CREATE FUNCTION in_area (BIGINT[]) RETURNS SETOF snapshot.area_parts AS $$
+  SELECT * FROM snapshot.area_parts WHERE area_id = ANY ($1);
+$$ LANGUAGE SQL STABLE PARALLEL SAFE;
+
+
+CREATE VIEW all_routes_view AS
+SELECT c.way_id,
+       ref_agg (r.tags->'ref') AS refs,
+       ref_agg (r.tags->'name') AS names,
+       array_agg (r.id ORDER BY r.id) AS rel_ids
+FROM snapshot.way_relation_closure c
+  JOIN snapshot.relations r ON r.id = c.rel_id
+WHERE r.tags->'route' IN  ('foot', 'hiking') -- , 'bicycle', 'mtb', 'piste', 'bus')
+GROUP BY c.way_id;
+
+CREATE VIEW snapshot.way_super_routes_view AS
+-- the membership rows that make a way part of a relation
+SELECT c.way_id, rm.*
+FROM snapshot.way_relation_closure c
+  JOIN snapshot.relation_members rm ON rm.relation_id = c.rel_id
+WHERE (rm.member_id, rm.member_type) = (c.way_id, 'W')
+   OR (rm.member_type = 'R' AND EXISTS (
+         SELECT 1 FROM snapshot.way_relation_closure sc
+         WHERE (sc.way_id, sc.rel_id) = (c.way_id, rm.member_id)));
 
 
 UPDATE planet_osm_line l
@@ -203,7 +323,7 @@ WITH points3d AS (
       JOIN raster_dtm dtm ON (ST_Intersects (dtm.rast, p.geom))
     )
 SELECT ST_MakeLine (geom) FROM points3d;
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 -- returns altimetry of a linestring, elevation in m in Z
 -- note: osmosis snapshot is in 4326 but raster is in 3857
@@ -219,7 +339,7 @@ WITH points3d AS (
         LEFT JOIN raster_dtm dtm ON (ST_Intersects (dtm.rast, ST_Transform (p.geom, 3857)))
     )
 SELECT ST_MakeLine (geom) FROM points3d;
-$$ LANGUAGE SQL IMMUTABLE;
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
 
 -- add ways with precomputed altitudes to all known routes
 ALTER TABLE snapshot.ways ADD COLUMN IF NOT EXISTS linestringz geometry (LineStringZ, 4326);
@@ -314,6 +434,24 @@ SELECT r.id                  AS rel,
 FROM snapshot.relations r
 WHERE r.tags->'route' IN ('foot', 'hiking', 'bicycle', 'mtb', 'piste', 'bus');
 
+-- the tag problems found by scripts/check_route_tags.py, with suggested fix
+CREATE TABLE IF NOT EXISTS qa_findings (
+  rel       BIGINT NOT NULL,
+  version   INT,
+  uid       INT,
+  route     TEXT,
+  rule      TEXT NOT NULL,
+  tag       TEXT NOT NULL,
+  value     TEXT,
+  fix       TEXT,
+  confirmed BOOLEAN  -- NULL: not checked against the live data yet
+);
+
+CREATE INDEX IF NOT EXISTS qa_findings_rel_idx ON qa_findings (rel);
+
+-- the snapshot may have changed
+TRUNCATE qa_findings;
+
 
 -- to check if route segments are ordered
 CREATE VIEW route_lines AS
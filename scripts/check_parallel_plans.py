@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+"""Check that PostgreSQL uses parallel plans for our heavy queries.
+
+Runs EXPLAIN on the aggregations in :file:`hikemap.sql` and on the views used
+by the mapnik layers and reports the number of parallel workers planned.  Warns
+if a query that should run in parallel gets a serial plan, eg. because some
+function in it is not declared PARALLEL SAFE.  With --strict that is an error.
+
+"""
+
+import argparse
+import sys
+
+import sqlalchemy
+
+import connect
+
+QUERIES = (
+    # name, must be parallel, query
+    ('ref_agg', True, """
+    SELECT osm_id % 1000, ref_agg (ref), ref_agg (name)
+    FROM planet_osm_line
+    GROUP BY osm_id % 1000
+    """),
+    ('all_routes_view', True, """
+    SELECT * FROM all_routes_view
+    """),
+    ('hiking_paths_fill_view', True, """
+    SELECT * FROM hiking_paths_fill_view
+    """),
+    ('hiking_roads_text_ref', True, """
+    SELECT * FROM hiking_roads_text_ref
+    """),
+    ('hiking_paths_text_name', True, """
+    SELECT * FROM hiking_paths_text_name
+    """),
+    ('local_names', True, """
+    SELECT * FROM local_names
+    """),
+)
+""" The queries to check. """
+
+
+def gather_nodes (plan):
+    """ Yield all Gather and Gather Merge nodes in a JSON plan tree. """
+
+    if plan['Node Type'] in ('Gather', 'Gather Merge'):
+        yield plan
+    for subplan in plan.get ('Plans', []):
+        yield from gather_nodes (subplan)
+
+
+def build_parser ():
+    """ Build the commandline parser. """
+
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument (
+        '-v', '--verbose', dest='verbose', action='count',
+        help='also print the plans', default=0
+    )
+    parser.add_argument (
+        '--strict', action='store_true',
+        help='exit with an error if a query gets no parallel plan',
+    )
+    parser.add_argument (
+        'queries', nargs='*', metavar='QUERY',
+        help='check only these queries (%s)' % ', '.join ([q[0] for q in QUERIES]),
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser ().parse_args ()
+
+    conn = connect.get_engine ().connect ()
+
+    failed = []
+    for name, must_be_parallel, sql in QUERIES:
+        if args.queries and name not in args.queries:
+            continue
+
+        plan = conn.execute (sqlalchemy.text ('EXPLAIN (FORMAT JSON) ' + sql.strip ())).scalar ()
+        plan = plan[0]['Plan']
+        workers = sum ([g.get ('Workers Planned', 0) for g in gather_nodes (plan)])
+
+        print ("{name:24} {workers:2d} workers planned".format (name = name, workers = workers))
+        if args.verbose:
+            for row in conn.execute (sqlalchemy.text ('EXPLAIN ' + sql.strip ())):
+                print ('    ' + row[0])
+
+        if must_be_parallel and workers == 0:
+            failed.append (name)
+
+    if failed:
+        print ('%s: no parallel plan for: %s' % ('Error' if args.strict else 'Warning', ' '.join (failed)))
+        if args.strict:
+            sys.exit (1)
@@ -3,6 +3,7 @@
 """ Check ways in OSM for the presence of hiking related refs. """
 
 import argparse
+import logging
 import re
 
 from osgeo import ogr, osr, gdal
@@ -10,12 +11,16 @@ import osmapi
 import sqlalchemy
 
 import connect
+import osm_upload
+import tag_rules
 
 MY_UID = 8199540
 
+rules = tag_rules.load ()
+
 RE_NAME_SPLIT = re.compile (' - ')
-RE_REF = re.compile ('^(SI|Fer|PU|P|(E|AV)?\d+[A-Z]?)$')
-RE_BAD_NAMES = re.compile (r'\(SI|Sentiero Italia|Alta via|Dolomiten-Höhenweg|Traumpfad')
+RE_REF = rules.ref_in_name
+RE_BAD_NAMES = rules.bad_names
 
 def split_ref (ref):
     return set (ref.split (';') if ref else [])
@@ -46,6 +51,30 @@ def set_tag (way, name, value):
     else:
         del way['tag'][name]
 
+def local_problem (row):
+    """ Return True if the local database indicates a problem with the way. """
+
+    way_id, route_refs, route_names, rel_ids, highway, ref, name, length = row
+
+    refs_in_routes  = set ([r for r in route_refs  if r is not None] if route_refs else [])
+
+    names_in_routes = set ()
+    if route_names:
+        for route_name in route_names:
+            if route_name and not RE_BAD_NAMES.search (route_name):
+                refs_in_name, names_in_name = split_name (name)
+                names_in_routes |= names_in_name
+    names_in_routes -= refs_in_routes
+
+    refs_in_ref                 = split_ref (ref)
+    refs_in_name, names_in_name = split_name (name)
+
+    return ((ref == '') or
+            (name == '') or
+            (refs_in_routes != refs_in_ref) or
+            (highway == 'track' and refs_in_name) or
+            (highway != 'track' and (refs_in_routes != refs_in_name) or (names_in_routes - names_in_name)))
+
 def build_parser ():
     """ Build the commandline parser. """
 
@@ -55,6 +84,10 @@ def build_parser ():
         '-v', '--verbose', dest='verbose', action='count',
         help='increase output verbosity', default=0
     )
+    parser.add_argument (
+        '-a', '--areas', nargs='+', type=int, required=True, metavar='OSM_RELID',
+        help='check the ways in these areas',
+    )
     parser.add_argument (
         '-l', '--live', dest='get_live_data', action='store_true',
         help='get live data from OSM database',
@@ -75,42 +108,39 @@ def build_parser ():
         '--batch-size', dest="batch_size", type=int, default=10,
         help='apply OSM edits in changesets of this size (default=10)',
     )
+    parser.add_argument (
+        '--api', metavar='URL',
+        help='use this OSM API server, eg. a mock server (default=openstreetmap.org)',
+    )
+    parser.add_argument (
+        '--journal', metavar='FILENAME', default='data/check-path-names.journal',
+        help='journal of the uploads, to resume an interrupted run (default=data/check-path-names.journal)',
+    )
+    parser.add_argument (
+        '--cache', metavar='FILENAME', default='data/osm-cache.sqlite',
+        help="cache OSM data in this file, '' for no cache (default=data/osm-cache.sqlite)",
+    )
+    parser.add_argument (
+        '--cache-max-age', dest='cache_max_age', type=float, metavar='SECONDS', default=86400,
+        help='refetch cached OSM data older than this (default=86400)',
+    )
     return parser
 
 
 if __name__ == "__main__":
-    api = connect.api
-    cs = None
-    changes = 0
-    relations = dict ()
-
     args = build_parser ().parse_args ()
 
     args.get_live_data |= args.edit # only edit live data
 
-    # get all paths and tracks that are in a hiking route
-    rows = connect.conn.execute (sqlalchemy.text ("""
-    WITH routes AS (
-        WITH RECURSIVE rec_routes (way_id, rel_id, rel_tags) AS (
-            -- select all lines in some relation
-            SELECT line.osm_id AS way_id, r.id AS rel_id, r.tags AS rel_tags
-            FROM planet_osm_line line
-              JOIN relations_of r ON r.member_id = line.osm_id
-          UNION
-            -- add all super relations
-            SELECT ar.way_id, r.id AS rel_id, r.tags AS rel_tags
-            FROM rec_routes ar
-              JOIN relations_of r ON r.member_id = ar.rel_id
-        )
-    SELECT way_id,
-           array_agg (rel_tags->'ref') AS refs,
-           array_agg (rel_tags->'name') AS names,
-           array_agg (rel_id) AS rel_ids
-    FROM rec_routes
-    WHERE rel_tags->'route' = 'hiking'
-    GROUP BY way_id
-    )
+    connect.init_cache (args.cache, args.cache_max_age, False)
+    connect.init_api (url = args.api)
+    uploader = osm_upload.Uploader (connect.api, args.journal, args.batch_size)
+    conn = connect.get_engine ().connect ()
+    connect.log = logging.getLogger ().log
+    areas = connect.ensure_areas (conn, args.areas)
 
+    # get all paths and tracks that are in a hiking route
+    rows = conn.execute (sqlalchemy.text ("""
     SELECT w.id               AS way_id,
            refs,
            names,
@@ -120,14 +150,44 @@ if __name__ == "__main__":
            w.tags->'name'     AS "name",
            ST_Length (w.linestring::geography) AS length
     FROM snapshot.ways w
-      LEFT JOIN routes r ON w.id = r.way_id
+      -- the hiking routes the way is in, directly or through super relations
+      LEFT JOIN LATERAL (
+        SELECT array_agg (r.tags->'ref')  AS refs,
+               array_agg (r.tags->'name') AS names,
+               array_agg (r.id)           AS rel_ids
+        FROM snapshot.way_relation_closure c
+          JOIN snapshot.relations r ON r.id = c.rel_id
+        WHERE c.way_id = w.id AND r.tags->'route' = 'hiking'
+      ) r ON true
     WHERE w.tags->'highway' IN ('track', 'path', 'footway')
-          AND ST_Intersects (:boundary, w.linestring)
+          AND EXISTS (SELECT 1 FROM in_area (CAST (:areas AS BIGINT[])) a
+                      WHERE ST_Intersects (a.geom, w.linestring))
           -- AND ST_Length (w.linestring::geography) > :min_length
     ORDER BY length DESC
-    """), { 'boundary' : connect.boundary, 'min_length' : args.min_length })
+    """), { 'areas' : areas, 'min_length' : args.min_length })
+
+    rows = rows.fetchall ()
+    print ("Checking %d ways" % len (rows))
+
+    # First pass: find the ways that look suspicious in the local database and
+    # get their live data from the api in batches, together with the relations
+    # they are in now.  We don't edit stale data, so when editing we refetch all.
+
+    live_ways = dict ()
+    live_parents = dict ()
+    suspicious = set ()
 
-    print ("Checking %d ways" % rows.rowcount)
+    if args.get_live_data:
+        max_age = 0 if args.edit else None
+        suspicious_rows = [ row for row in rows if local_problem (row) ]
+        suspicious = set ([ row[0] for row in suspicious_rows ])
+        print ("Getting live data for %d ways" % len (suspicious))
+
+        live_ways = connect.get_ways (suspicious, max_age)
+        # the snapshot may miss relations the way was added to since
+        live_parents = connect.get_parent_relations ('way', live_ways, max_age)
+
+    # Second pass: check
 
     faulty_ways = set ()
 
@@ -156,51 +216,37 @@ if __name__ == "__main__":
         refs_in_ref                 = split_ref (ref)
         refs_in_name, names_in_name = split_name (name)
 
-        # do a quick check of the local database
-        if args.get_live_data and (
-                (ref == '') or
-                (name == '') or
-                (refs_in_routes != refs_in_ref) or
-                (highway == 'track' and refs_in_name) or
-                (highway != 'track' and (refs_in_routes != refs_in_name) or (names_in_routes - names_in_name))):
+        if way_id in suspicious:
 
             # the local database indicates a problem
-            # get live data from the api and try again
+            # use live data and try again
             refs_in_routes  = set ()
             names_in_routes = set ()
-            try:
-                way     = api.WayGet (way_id)
-                ref     = way['tag'].get ('ref')
-                name    = way['tag'].get ('name')
-                highway = way['tag'].get ('highway')
-
-                way_rels = api.WayRelations (way_id)
-                for way_rel in way_rels:
-                    rel_id = way_rel['id']
-                    if rel_id not in relations:
-                        relations[rel_id] = way_rel # cache relations
-                    r = relations[rel_id]
-                    rel_ref   = r['tag'].get ('ref')
-                    rel_name  = r['tag'].get ('name')
-                    rel_route = r['tag'].get ('route')
-
-                    if rel_route == 'hiking':
-                        if rel_ref:
-                            refs_in_routes.add (rel_ref)
-                        if rel_name and not RE_BAD_NAMES.search (rel_name):
-                            names_in_routes |= split_name (rel_name)[1]
-
-                        if r['uid'] == MY_UID:
-                            my_edit = True
-
-            except (osmapi.XmlResponseInvalidError) as e:
-                # way has no relations
-                pass
-
-            except (KeyError, osmapi.ElementDeletedApiError) as e:
-                print ("%s in rel_id %s" % (e, rel_id))
+
+            way = live_ways.get (way_id)
+            if way is None:
+                print ("way %d was deleted" % way_id)
                 continue
 
+            ref     = way['tag'].get ('ref')
+            name    = way['tag'].get ('name')
+            highway = way['tag'].get ('highway')
+
+            # the live relations of the way, directly or through super relations
+            for r in live_parents.get (way_id, []):
+                rel_ref   = r['tag'].get ('ref')
+                rel_name  = r['tag'].get ('name')
+                rel_route = r['tag'].get ('route')
+
+                if rel_route == 'hiking':
+                    if rel_ref:
+                        refs_in_routes.add (rel_ref)
+                    if rel_name and not RE_BAD_NAMES.search (rel_name):
+                        names_in_routes |= split_name (rel_name)[1]
+
+                    if r['uid'] == MY_UID:
+                        my_edit = True
+
             # only edit relations I touched last
             if args.my_edits and not my_edit:
                 continue
@@ -308,24 +354,9 @@ if __name__ == "__main__":
                     faulty_ways.add (way_id)
 
         if way and row_changed and args.edit:
-            if cs is None:
-                cs = api.ChangesetCreate ({})
-
-            way = api.WayUpdate (way)
-            changes += 1
             comment.add ('add refs from hiking routes to tracks, to make the routes show up on the main osm map')
+            uploader.modify ('way', way, comment)
 
-            if changes >= args.batch_size:
-                print ("changeset %d (%d changes)" % (cs, changes))
-                api.ChangesetUpdate ({ 'comment' : ', '.join (list (comment)) })
-                api.ChangesetClose ()
-                cs = None
-                changes = 0
-                comment = set ()
-
-    if cs is not None:
-        print ("changeset %d (%d changes)" % (cs, changes))
-        api.ChangesetUpdate ({ 'comment' : ', '.join (list (comment)) })
-        api.ChangesetClose ()
+    uploader.flush ()
 
     print ('Faulty way ids: ' + ' '.join ([str (n) for n in sorted (faulty_ways)]))
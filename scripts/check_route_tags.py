@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+"""Check the tags of all route relations in the local database.
+
+Runs the rules in :file:`tag_rules.yml` as set-based SQL over
+snapshot.relations and writes the findings, with a suggested fix where there
+is one, into the table qa_findings.  Only then, if asked to, gets the live
+versions of the flagged relations from the OSM API in batches and marks the
+findings that still apply as confirmed.
+
+"""
+
+import argparse
+import logging
+import re
+import time
+
+import sqlalchemy
+
+import connect
+import tag_rules
+
+FINDINGS = (
+    # rule, tag, condition, fix
+    ('name-ref-prefix', 'name',        "left (name, length (ref) + 3) = ref || ' - ' "
+                                       "AND length (name) > length (ref) + 3",             "substr (name, length (ref) + 4)"),
+    ('bogus-name',      'name',        "name ~ name_rx",                                   "NULL"),
+    ('no-network',      'network',     "network IS NULL AND network_rx IS NOT NULL",       "default_network"),
+    ('bogus-network',   'network',     "network !~ network_rx",                            "NULL"),
+    ('bogus-symbol',    'osmc:symbol', "symbol ~ :bogus_symbol",                           "template"),
+    ('symbol-mismatch', 'osmc:symbol', "ref <> '' AND coalesce (symbol, '') !~ symbol_rx", "template"),
+)
+""" The checks: rule id, the tag checked, the SQL condition, the SQL for the fix. """
+
+
+def route_case (mapping, params, name):
+    """ Return an SQL CASE that maps the route type through mapping. """
+
+    if not mapping:
+        return 'NULL'
+    whens = []
+    for i, (route, value) in enumerate (sorted (mapping.items ())):
+        params['%s_route%d' % (name, i)] = route
+        params['%s_value%d' % (name, i)] = getattr (value, 'pattern', value)
+        whens.append ('WHEN :{name}_route{i} THEN :{name}_value{i}'.format (name = name, i = i))
+    return 'CASE route %s END' % ' '.join (whens)
+
+
+def symbol_cases (rules, params):
+    """Return the SQL CASEs for the symbol pattern and the symbol template of a ref.
+
+    The first rule whose ref pattern matches wins, like in
+    :meth:`tag_rules.TagRules.symbol_rule`.
+
+    """
+
+    params['special'] = '([^[:alnum:]_])'
+    params['escape']  = r'\\\1'
+
+    def escape (expr):
+        return 'regexp_replace (%s, :special, :escape, \'g\')' % expr
+
+    rx_whens = []
+    template_whens = []
+    for i, rule in enumerate (rules.symbol_rules):
+        params['ref%d' % i] = '^(?:%s)$' % rule['ref']
+        group = "coalesce (substring (ref FROM :ref%d), '')" % i if re.compile (rule['ref']).groups else "''"
+        when = 'WHEN ref ~ :ref%d THEN ' % i
+
+        if rule.get ('symbol'):
+            params['symbol%d' % i] = rule['symbol']
+            rx_whens.append (when + "replace (:symbol%d, '{1}', %s)" % (i, escape (group)))
+        else:
+            rx_whens.append (when + 'NULL')
+
+        if 'template' in rule:
+            params['template%d' % i] = rule['template']
+            template_whens.append (when + "replace (:template%d, '{1}', %s)" % (i, group))
+
+    rx = "CASE %s ELSE ':' || %s || ':' END" % (' '.join (rx_whens), escape ('ref'))
+    template = 'CASE %s END' % ' '.join (template_whens) if template_whens else 'NULL'
+    return rx, template
+
+
+def findings_query (conn, rules, types = connect.CHECKED_TYPES, areas = None, my_edits = False):
+    """Return the SQL and the parameters of the query that checks the route relations.
+
+    The query checks all route relations of types in the database, optionally
+    only the relations with a member way in areas, or last edited by me.  It
+    returns the columns of qa_findings without confirmed.
+
+    """
+
+    params = {
+        'types'        : list (types),
+        'bogus_symbol' : rules.bogus_symbol.pattern,
+    }
+
+    where = ''
+    if areas:
+        params['areas'] = connect.ensure_areas (conn, areas)
+        where += """
+      AND EXISTS (SELECT 1
+                  FROM snapshot.relation_members rm
+                    JOIN snapshot.ways w ON w.id = rm.member_id
+                    JOIN in_area (CAST (:areas AS BIGINT[])) a ON ST_Intersects (a.geom, w.linestring)
+                  WHERE (rm.relation_id, rm.member_type) = (r.id, 'W'))"""
+    if my_edits:
+        params['uid'] = connect.MY_UID
+        where += """
+      AND r.user_id = :uid"""
+
+    symbol_rx, template = symbol_cases (rules, params)
+
+    selects = []
+    for i, (rule, tag, condition, fix) in enumerate (FINDINGS):
+        params['rule%d' % i] = rule
+        params['tag%d' % i] = tag
+        column = { 'osmc:symbol' : 'symbol' }.get (tag, tag)
+        selects.append ("""
+    SELECT id AS rel, version, uid, route, :rule{i} AS rule, :tag{i} AS tag, {column} AS value, {fix} AS fix
+    FROM r
+    WHERE {condition}""".format (i = i, column = column, fix = fix, condition = condition))
+
+    sql = """
+    WITH r AS (
+      SELECT *,
+             {name_rx}         AS name_rx,
+             {network_rx}      AS network_rx,
+             {default_network} AS default_network,
+             {symbol_rx}       AS symbol_rx,
+             {template}        AS template
+      FROM (
+        SELECT r.id, r.version, r.user_id AS uid,
+               r.tags->(r.tags->'type')  AS route,
+               r.tags->'ref'             AS "ref",
+               r.tags->'name'            AS "name",
+               r.tags->'network'         AS network,
+               r.tags->'osmc:symbol'     AS symbol
+        FROM snapshot.relations r
+        WHERE r.tags->(r.tags->'type') = ANY (:types){where}
+      ) r
+    )
+    {selects}
+    """.format (
+        name_rx         = route_case (rules.bogus_name, params, 'name'),
+        network_rx      = route_case (rules.network, params, 'network'),
+        default_network = route_case (rules.default_network, params, 'default'),
+        symbol_rx       = symbol_rx,
+        template        = template,
+        where           = where,
+        selects         = '\n    UNION ALL'.join (selects),
+    )
+    return sql, params
+
+
+def find_problems (conn, rules, types = connect.CHECKED_TYPES, areas = None, my_edits = False):
+    """Check the route relations and fill qa_findings.
+
+    See :func:`findings_query` for the arguments.  Returns the number of findings.
+
+    """
+
+    sql, params = findings_query (conn, rules, types, areas, my_edits)
+
+    with conn.begin ():
+        conn.execute (sqlalchemy.text ('TRUNCATE qa_findings'))
+        res = conn.execute (sqlalchemy.text (
+            "INSERT INTO qa_findings (rel, version, uid, route, rule, tag, value, fix)" + sql
+        ), params)
+
+    return res.rowcount
+
+
+def confirm_problems (conn, max_age = None):
+    """Check the findings against the live data of the flagged relations.
+
+    Gets the relations from the OSM API in batches and sets confirmed on every
+    finding.  A finding is confirmed if the live tag still has the value found
+    in the database.
+
+    """
+
+    with conn.begin ():
+        findings = conn.execute (sqlalchemy.text ("SELECT rel, rule, tag, value FROM qa_findings")).fetchall ()
+        relations = connect.get_relations (set ([ f[0] for f in findings ]), max_age)
+
+        updates = []
+        for rel, rule, tag, value in findings:
+            r = relations.get (rel)
+            updates.append ({
+                'rel'       : rel,
+                'rule'      : rule,
+                'confirmed' : r is not None and r['tag'].get (tag) == value,
+            })
+
+        if updates:
+            conn.execute (sqlalchemy.text (
+                "UPDATE qa_findings SET confirmed = :confirmed WHERE rel = :rel AND rule = :rule"
+            ), updates)
+
+
+def build_parser ():
+    """ Build the commandline parser. """
+
+    parser = argparse.ArgumentParser (description = __doc__, fromfile_prefix_chars = '@')
+
+    parser.add_argument (
+        '-v', '--verbose', dest='verbose', action='count',
+        help='also list the findings', default=0
+    )
+    parser.add_argument (
+        '-a', '--areas', nargs='+', type=int, metavar='OSM_RELID',
+        help='check only the routes in these areas (default: all)',
+    )
+    parser.add_argument (
+        '-r', '--routes', nargs='+', metavar='ROUTE',
+        choices = connect.CHECKED_TYPES, default = connect.CHECKED_TYPES,
+        help='route types to check (%s)' % ', '.join (connect.CHECKED_TYPES),
+    )
+    parser.add_argument (
+        '-u', '--user', dest='my_edits', action='store_true',
+        help='only check relations I edited last',
+    )
+    parser.add_argument (
+        '-l', '--live', dest='get_live_data', action='store_true',
+        help='check the findings against live data from the OSM API',
+    )
+    parser.add_argument (
+        '--rules', metavar='FILENAME', default=tag_rules.DEFAULT_FILE,
+        help='the tag rules (default=%s)' % tag_rules.DEFAULT_FILE,
+    )
+    parser.add_argument (
+        '--cache', metavar='FILENAME', default='data/osm-cache.sqlite',
+        help="cache OSM data in this file, '' for no cache (default=data/osm-cache.sqlite)",
+    )
+    parser.add_argument (
+        '--cache-max-age', dest='cache_max_age', type=float, metavar='SECONDS', default=86400,
+        help='refetch cached OSM data older than this (default=86400)',
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser ().parse_args ()
+
+    logging.basicConfig (format = '%(message)s', level = logging.INFO if args.verbose else logging.WARN)
+    connect.log = logging.getLogger ().log
+
+    conn = connect.get_engine ().connect ()
+
+    start = time.time ()
+    count = find_problems (conn, tag_rules.load (args.rules), args.routes, args.areas, args.my_edits)
+    print ("Found %d problems in %.1fs" % (count, time.time () - start))
+
+    if args.get_live_data and count:
+        connect.init_cache (args.cache, args.cache_max_age, False)
+        connect.init_api ()
+        start = time.time ()
+        confirm_problems (conn)
+        print ("Checked live data in %.1fs" % (time.time () - start))
+
+    for rule, total, confirmed, fixable in conn.execute (sqlalchemy.text ("""
+    SELECT rule, count (*), count (*) FILTER (WHERE confirmed), count (fix)
+    FROM qa_findings
+    GROUP BY rule
+    ORDER BY rule
+    """)):
+        print ("{rule:16} {total:6d} {confirmed:6d} confirmed {fixable:6d} fixable".format (
+            rule = rule, total = total, confirmed = confirmed, fixable = fixable))
+
+    if args.verbose:
+        for rel, route, rule, tag, value, fix, confirmed in conn.execute (sqlalchemy.text ("""
+        SELECT rel, route, rule, tag, value, fix, confirmed
+        FROM qa_findings
+        WHERE confirmed IS NOT FALSE
+        ORDER BY rule, rel
+        """)):
+            print ('{rule:16} {route:8} {rel:10d} {tag}="{value}"{fix}'.format (
+                rule = rule, route = route, rel = rel, tag = tag, value = value or '',
+                fix = ' -> "%s"' % fix if fix else ''))
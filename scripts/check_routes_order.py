@@ -20,13 +20,19 @@ import itertools
 import logging
 from logging import ERROR, WARN, INFO, DEBUG
 import operator
+import hashlib
 import json
+import multiprocessing
 import re
+import sqlite3
 import sys
 import traceback
 
 import connect
 import geokatalog
+import tag_rules
+
+rules = tag_rules.load ()
 
 
 def get_route_type (rtags):
@@ -37,65 +43,34 @@ def check_osmc_symbol (rtags, errors):
     sym = rtags.get ('osmc:symbol', '')
     ref = rtags.get ('ref')
 
-    m = re.match (r'^(.*?):red:white_', sym)
-    if m and m.group (1) != 'red':
+    if rules.bogus_symbol.match (sym):
         errors.append ((ERROR, '  Bogus osmc:symbol {sym}'.format (sym = sym)))
 
     if ref:
-        rx = ':%s:' % ref
-
-        m = re.match (r'([0-9]{1,2}[ABC]?)$', ref)
-        if m:
-            rx = '^red:red:white_bar:%s:black$' % m.group (1)
-
-        m = re.match (r'(?:E|O)([0-9]{3}[ABC]?)$', ref) # Trentino Est / Ovest
-        if m:
-            rx = '^red:red:white_stripe:%s:black$' % m.group (1)
-
-        m = re.match (r'AV([0-9])$', ref) # Alta Via
-        if m:
-            rx = '^red::blue_triangle_line:%s:blue$' % m.group (1)
-
-        m = re.match (r'E([1-9])$', ref) # Europaweg E5
-        if m:
-            rx = '^red:red:white_bar$'
-
-        m = re.match (r'VA-([A-Z][0-9]+)$', ref) # Via Alpina
-        if m:
-            rx = '^red::gray_triangle:V:blue$'
-
-        m = re.match (r'SI', ref)
-        if m:
-            rx = None
-
-        if rx and not re.search (rx, sym):
+        rx = rules.symbol_pattern (ref)
+        if rx and not rx.search (sym):
             errors.append ((ERROR, '  Ref {ref} and osmc:symbol {sym} mismatch.'.format (ref = ref, sym = sym)))
 
 
 def check_stop_tags (stops, errors):
     for stop in stops:
-        stags = stop['tags']
+        stags = stop.tags
 
         pt = stags.get ('public_transport')
         if pt != 'stop_position':
-            errors.append ((ERROR, '  Stop {id} is missing tags.'.format (id = stop['id'])))
+            errors.append ((ERROR, '  Stop {id} is missing tags.'.format (id = stop.id)))
 
 
 def check_network (rtags, errors):
     route = get_route_type (rtags)
     network = rtags.get ('network')
 
-    rx = None
-    if route in connect.HIKING_TYPES:
-        rx = r'^[lrni]wn$'
-    if route == 'bicycle':
-        rx = r'^[lrni]cn$'
-
+    rx = rules.network.get (route)
     if rx:
         if network is None:
             errors.append ((ERROR, '  No network in route'))
         else:
-            m = re.search (rx, network)
+            m = rx.search (network)
             if not m:
                 errors.append ((ERROR, '  Bogus network {nw} in route'.format (nw = network)))
 
@@ -103,53 +78,43 @@ def check_network (rtags, errors):
 def check_name (rtags, errors):
     route = get_route_type (rtags)
     name = rtags.get ('name')
-    if name and route in connect.HIKING_TYPES:
-        m = re.search (r'^\d+\w?$', name)
+    rx = rules.bogus_name.get (route)
+    if name and rx:
+        m = rx.search (name)
         if m:
             errors.append ((ERROR, '  Bogus name {name} in route'.format (name = name)))
 
 
-def ways_ok (rfull, ways, stops = [], direction = ''):
-    relation = rfull[-1]
-
-    rtags  = relation['tags']
-    route = get_route_type (rtags)
-    rel_id = relation['id']
-    expected_chunks = connect.CHUNKS.get (rel_id, 1)
-
-    chunks = []
-    chunk = []
-    error_msgs = []
+class RouteGraph ():
+    """The ways of a route relation in a compact form for the connectivity checks.
 
-    # filter non-ways
-    ways = [ w for w in ways if connect.way_is_way (w) ]
+    Holds the node ids of every way as tuple, the first and last node, and the
+    oneway, area and way flags.  The flags are derived from the tags once per
+    way, for the route type of the relation.  Ways are addressed by their index.
 
-    # the node(s) last reached
-    last_nodes = set ()
+    """
 
-    # to know the first way's orientation we have to peek at the second way
-    if len (ways) > 1:
-        w0nodes = ways[0]['nodes']
-        w1nodes = ways[1]['nodes']
-        if connect.way_is_area (ways[0]):
-            # route can start with any node of the first way
-            last_nodes = set ( w0nodes )
-        elif w0nodes[-1] in w1nodes:
-            # the first way is forward, route starts with the first node of the first way
-            last_nodes = { w0nodes[0] }
-        elif w0nodes[0] in w1nodes:
-            # the first way is backward, route starts with the last node of the first way
-            last_nodes = { w0nodes[-1] }
+    def __init__ (self, relation, store):
+        self.relation = relation
+        self.rel_id   = relation.id
+        self.route    = route = get_route_type (relation.tags)
 
-    next_stop = stops.pop (0) if stops else None
+        # the distinct member ways
+        ways = list (dict ([ (w.id, w) for w in store.member_ways (relation) ]).values ())
 
-    for way in ways:
-        wtags   = way['tags']
-        wnodes  = way['nodes']
-        reverse = None # do we use the way in reverse direction?
+        self.index  = dict ([ (w.id, i) for i, w in enumerate (ways) ])
+        self.ids    = [ w.id for w in ways ]
+        self.names  = [ w.tags.get ('name', 'unnamed') for w in ways ]
+        self.nodes  = [ w.nodes for w in ways ]
+        self.first  = [ n[0]  for n in self.nodes ]
+        self.last   = [ n[-1] for n in self.nodes ]
+        self.is_way = [ connect.way_is_way (w) for w in ways ]
+        self.area   = [ connect.way_is_area (w) for w in ways ]
+        self.oneway = [ self.is_oneway (w.tags, route) for w in ways ]
 
+    @staticmethod
+    def is_oneway (wtags, route):
         roundabout = wtags.get ('junction', '') in ('roundabout', 'circular')
-        is_area = connect.way_is_area (way)
 
         oneway = wtags.get ('oneway', 'no')
         if route == 'bus':
@@ -164,6 +129,54 @@ def ways_ok (rfull, ways, stops = [], direction = ''):
             oneway = True # mtb tours
         if route in connect.HIKING_TYPES:
             oneway = False
+        return oneway
+
+    def members (self, roles):
+        """ Return the indices of the member ways with one of roles, in order. """
+
+        return [ self.index[ref] for ref in self.relation.member_refs ('way', roles) ]
+
+
+def ways_ok (graph, ways, stops = (), direction = ''):
+    """Check the connectivity of a sequence of ways and the order of the stops.
+
+    ways is a list of way indices into graph, stops a list of stop nodes.
+
+    """
+
+    expected_chunks = connect.CHUNKS.get (graph.rel_id, 1)
+
+    chunks = []
+    chunk = []
+    error_msgs = []
+
+    # filter non-ways
+    ways = [ i for i in ways if graph.is_way[i] ]
+
+    # the node(s) last reached
+    last_nodes = set ()
+
+    # to know the first way's orientation we have to peek at the second way
+    if len (ways) > 1:
+        w0, w1 = ways[0], ways[1]
+        if graph.area[w0]:
+            # route can start with any node of the first way
+            last_nodes = set (graph.nodes[w0])
+        elif graph.last[w0] in graph.nodes[w1]:
+            # the first way is forward, route starts with the first node of the first way
+            last_nodes = { graph.first[w0] }
+        elif graph.first[w0] in graph.nodes[w1]:
+            # the first way is backward, route starts with the last node of the first way
+            last_nodes = { graph.last[w0] }
+
+    stops = collections.deque (stops)
+    next_stop = stops.popleft () if stops else None
+
+    for i in ways:
+        wnodes  = graph.nodes[i]
+        oneway  = graph.oneway[i]
+        is_area = graph.area[i]
+        reverse = None # do we use the way in reverse direction?
 
         if is_area:
             # route can enter at any node
@@ -171,22 +184,22 @@ def ways_ok (rfull, ways, stops = [], direction = ''):
         else:
             if oneway:
                 # route can enter at first node only
-                nodes = { wnodes[0] }
+                nodes = { graph.first[i] }
             else:
                 # route can enter at both endnodes
-                nodes = { wnodes[0], wnodes[-1] }
+                nodes = { graph.first[i], graph.last[i] }
 
-        if len (last_nodes) > 0 and len (last_nodes & nodes) == 0:
+        if last_nodes and last_nodes.isdisjoint (nodes):
             last_nodes = set ()
             chunks.append (chunk)
             chunk = []
             if oneway:
                 error_msgs.append ((ERROR, '  Oneway violation in way "%s" (%d)' %
-                                   (wtags.get ('name', 'unnamed'), way['id'])))
+                                   (graph.names[i], graph.ids[i])))
             else:
                 if expected_chunks == 1:
                     error_msgs.append ((ERROR, '  Route disconnected at way "%s" (%d)' %
-                                       (wtags.get ('name', 'unnamed'), way['id'])))
+                                       (graph.names[i], graph.ids[i])))
 
         if is_area:
             # route can exit by any node
@@ -195,35 +208,36 @@ def ways_ok (rfull, ways, stops = [], direction = ''):
         else:
             if oneway:
                 # route can exit by last node only
-                last_nodes = { wnodes[-1] }
+                last_nodes = { graph.last[i] }
                 reverse = False
             else:
                 # route can exit by both endnodes
                 last_nodes = nodes - last_nodes
                 # which direction did we take?
                 # this is used to check bus stops
-                reverse = wnodes[0] in last_nodes
+                reverse = graph.first[i] in last_nodes
 
-        chunk.extend (reversed (wnodes) if reverse else wnodes)
+        wnodes = wnodes[::-1] if reverse else wnodes
+        chunk.extend (wnodes)
 
         # check stops in way
         if next_stop:
-            for node_id in (reversed (wnodes) if reverse else wnodes):
-                if node_id == next_stop['id']:
-                    stop_tags = next_stop['tags']
+            stop_id = next_stop.id
+            for node_id in wnodes:
+                if node_id == stop_id:
+                    stop_tags = next_stop.tags
                     # next stop reached
-                    name = stop_tags.get ('name', 'unnamed')
-                    # print ('  Stop reached "%s" %s road' % (name, 'in reversed' if reverse else ''))
                     sdirection = stop_tags.get ('direction', 'both')
                     if (sdirection == 'both') or (reverse is None) or (reverse == (sdirection == 'backward')):
                         # stop reached, on to the next one
-                        next_stop = stops.pop (0) if stops else None
+                        next_stop = stops.popleft () if stops else None
                         if next_stop is None:
                             break
+                        stop_id = next_stop.id
 
     if stops:
-        stop_id = stops[0]['id']
-        stags = stops[0]['tags']
+        stop_id = stops[0].id
+        stags = stops[0].tags
         name = stags.get ('name', '<noname>')
         error_msgs.append ((ERROR, '  Stop "{name}" ({stop_id}) not reached'.format (name = name, stop_id = stop_id)))
 
@@ -240,44 +254,183 @@ def ways_ok (rfull, ways, stops = [], direction = ''):
     return error_msgs, chunks
 
 
-def check_route (rfull, errors):
-    relation = rfull[-1]
-    rtags    = relation['tags']
+def check_route (relation, errors):
+    rtags    = relation.tags
     route    = get_route_type (rtags)
-    members  = relation['members']
+    members  = relation.members
 
     check_osmc_symbol (rtags, errors)
     check_network (rtags, errors)
     check_name (rtags, errors)
 
-    ways_dict = dict ([(w['id'], w) for w in rfull if w['type'] == 'way'])
+    graph = RouteGraph (relation, connect.store)
 
     oneway = rtags.get ('oneway', 'yes') == 'yes'
-    forward_backward = any ([w['role'] in ('forward', 'backward') for w in members])
+    forward_backward = any ([m.role in ('forward', 'backward') for m in members])
 
     if (route in ('road', 'bicycle')) or (route == 'mtb' and forward_backward):
-        ways = [ ways_dict[w['ref']] for w in members if w['type'] == 'way' and w['role'] in ('', 'forward') ]
-        err, chunks = ways_ok (rfull, ways, [], 'forward')
+        ways = graph.members (('', 'forward'))
+        err, chunks = ways_ok (graph, ways, [], 'forward')
         errors += err
 
-        ways = [ ways_dict[w['ref']] for w in members if w['type'] == 'way' and w['role'] in ('', 'backward') ]
-        err, chunks = ways_ok (rfull, reversed (ways), [], 'backward')
+        ways = graph.members (('', 'backward'))
+        err, chunks = ways_ok (graph, ways[::-1], [], 'backward')
         errors += err
 
     else:
-        ways = [ ways_dict[w['ref']] for w in members if w['type'] == 'way' and w['role'] in ('', 'start')]
+        ways = graph.members (('', 'start'))
         if route == 'bus':
-            nodes_dict = dict ([(n['id'], n) for n in rfull if n['type'] == 'node'])
-            stops = [ nodes_dict[n['ref']] for n in members
-                      if n['type'] == 'node' and n['role'] in ('stop', 'stop_exit_only', 'stop_entry_only') ]
-            err, chunks = ways_ok (rfull, ways, stops)
+            stops = connect.store.member_nodes (relation, ('stop', 'stop_exit_only', 'stop_entry_only'))
+            err, chunks = ways_ok (graph, ways, stops)
             errors += err
             check_stop_tags (stops, errors)
         else:
-            err, chunks = ways_ok (rfull, ways, [])
+            err, chunks = ways_ok (graph, ways, [])
             errors += err
 
 
+def check_osm_route (rel_id):
+    """Run all checks on one OSM route.
+
+    Returns the errors, True if the route was checked, and the traceback if a
+    check raised an exception.
+
+    """
+
+    osm_route = geokatalog.osm_routes[rel_id]
+    errors = []
+
+    try:
+        relation = osm_route['relation']
+        rtags = relation.tags
+
+        route = get_route_type (rtags)
+        if route not in connect.CHECKED_TYPES:
+            return errors, False, None
+
+        fixme = rtags.get ('fixme')
+        if fixme:
+            errors.append ((WARN, 'fixme: %s' % fixme))
+
+        check_route (relation, errors)
+
+        # check against geokatalog
+
+        if (sys.args.geokatalog
+            and rtags['type'] == 'route'  # not abandoned etc.
+            and route in connect.HIKING_TYPES
+            and 'buffered' in osm_route
+            and not re.match (r'E|O|SI|VA', rtags.get ('ref', ''))
+            and not 'via_ferrata_scale' in rtags
+            and not rtags.get ('hiking') == 'via_ferrata'):
+
+            geokatalog.check_osm_covered (rel_id, errors)
+
+    except Exception as e:
+        return errors, False, traceback.format_exc () # don't count crashed checks
+
+    return errors, True, None
+
+
+def check_gk_route (gk_id):
+    """ Run all checks on one geokatalog route.  Returns the errors. """
+
+    errors = []
+    if 'buffered' in geokatalog.gk_routes[gk_id]:
+        geokatalog.check_geokatalog_covered (gk_id, errors)
+    return errors
+
+
+def map_checks (func, ids):
+    """Apply func to all ids.  Yields the results in the order of ids.
+
+    With more than one job the checks run in a pool of forked processes.  The
+    workers share the read-only routes and STRtrees with the parent, so only
+    the ids and the errors are pickled.
+
+    """
+
+    if sys.args.jobs > 1:
+        with multiprocessing.get_context ('fork').Pool (sys.args.jobs) as pool:
+            yield from pool.imap (func, ids, chunksize = 8)
+    else:
+        yield from map (func, ids)
+
+
+class ResultStore ():
+    """A persistent store of check results for the incremental mode.
+
+    The results are keyed by the kind of route ('osm' or 'gk') and its id.
+    Every result remembers a digest of all inputs of the checks.  A result is
+    only valid as long as the digest matches.
+
+    """
+
+    VERSION = 2
+    """ Bump this to invalidate all stored results, eg. when a check changes. """
+
+    def __init__ (self, filename, salt):
+        self.conn = sqlite3.connect (filename, isolation_level = None)
+        self.conn.execute ("""
+        CREATE TABLE IF NOT EXISTS results (
+            kind   TEXT,
+            id     TEXT,
+            inputs TEXT,
+            result TEXT,
+            PRIMARY KEY (kind, id)
+        )
+        """)
+        self.salt = json.dumps ([self.VERSION, salt])
+
+    def digest (self, inputs):
+        return hashlib.sha1 ((self.salt + inputs).encode ('utf-8')).hexdigest ()
+
+    def get (self, kind, id_, inputs):
+        """ Return the stored result or None if there is none or the inputs changed. """
+
+        row = self.conn.execute (
+            'SELECT inputs, result FROM results WHERE kind = ? AND id = ?', (kind, str (id_))
+        ).fetchone ()
+        if row is None or row[0] != self.digest (inputs):
+            return None
+        return json.loads (row[1])
+
+    def put (self, kind, id_, inputs, result):
+        self.conn.execute (
+            'INSERT OR REPLACE INTO results (kind, id, inputs, result) VALUES (?, ?, ?, ?)',
+            (kind, str (id_), self.digest (inputs), json.dumps (result))
+        )
+
+
+def incremental_checks (kind, func, ids, inputs):
+    """Like :func:`map_checks` but reuse the stored results of unchanged routes.
+
+    inputs is a function that returns the inputs digest of a route.
+
+    """
+
+    if store is None:
+        yield from map_checks (func, ids)
+        return
+
+    digests = dict ([ (id_, inputs (id_)) for id_ in ids ])
+    results = dict ([ (id_, store.get (kind, id_, digests[id_])) for id_ in ids ])
+
+    todo = [ id_ for id_ in ids if results[id_] is None ]
+    log (INFO, '%d of %d %s routes changed' % (len (todo), len (ids), kind))
+
+    store.conn.execute ('BEGIN')
+    for id_, result in zip (todo, map_checks (func, todo)):
+        results[id_] = result
+        if kind == 'osm' and result[2] is not None:
+            continue # don't store crashes
+        store.put (kind, id_, digests[id_], result)
+    store.conn.execute ('COMMIT')
+
+    for id_ in ids:
+        yield results[id_]
+
+
 class Formatter (logging.Formatter):
     """ Logging formatter. Allows colorful formatting of log lines. """
 
@@ -335,6 +488,10 @@ def build_parser ():
 
     parser.add_argument ('-v', '--verbose', action='count',
                          help='increase output verbosity', default=0)
+    parser.add_argument ('-j', '--jobs', type=int,
+                         metavar='N',
+                         default=1,
+                         help="check routes in N parallel processes (default: 1)")
     parser.add_argument ('-a', '--areas', nargs='+',
                          metavar='OSM_RELID',
                          help='OSM id of area')
@@ -358,6 +515,26 @@ def build_parser ():
                          metavar='GEOKATALOG_ID',
                          default = [],
                          help="convert errors into warnings for these geokatalog routes")
+    parser.add_argument ('--source', choices = list (connect.SOURCES),
+                         default='api',
+                         help="get OSM data from the OSM API or from the local snapshot database (default: api)")
+    parser.add_argument ('--concurrency', type=int,
+                         metavar='N',
+                         default=8,
+                         help="max. concurrent requests to the OSM API (default: 8)")
+    parser.add_argument ('--cache',
+                         metavar='FILENAME',
+                         default='data/osm-cache.sqlite',
+                         help="cache OSM data in this file, '' for no cache (default: data/osm-cache.sqlite)")
+    parser.add_argument ('--cache-max-age', type=float, dest='cache_max_age',
+                         metavar='SECONDS',
+                         default=86400,
+                         help="revalidate cached OSM data older than this (default: 86400)")
+    parser.add_argument ('--offline', action='store_true',
+                         help="use cached OSM data only")
+    parser.add_argument ('--incremental',
+                         metavar='FILENAME',
+                         help="store the results in this file and only re-check changed routes")
     parser.add_argument ('--write-areas-bbox',
                          metavar='FILENAME',
                          help="output boundary of selected areas in WKT format")
@@ -381,74 +558,60 @@ if __name__ == '__main__':
     # get all route relations that intersect our area of interest
     #
 
-    connect.init ()
-
     # maybe just output areas
 
     if sys.args.write_areas_bbox:
+        if sys.args.source == 'db':
+            connect.log = log
+            bounds = connect.areas_bbox (connect.get_engine ().connect (), sys.args.areas)
+        else:
+            connect.init ()
+            bounds = connect.boundary.bounds
         with open (sys.args.write_areas_bbox, 'w') as fp:
-            fp.write ("{:.6f} {:.6f} {:.6f} {:.6f}".format (*connect.boundary.bounds))
+            fp.write ("{:.6f} {:.6f} {:.6f} {:.6f}".format (*bounds))
         sys.exit ()
 
-    log (INFO, 'querying overpass for route relations in areas ...')
-    osm_relations = connect.relations_in_areas (sys.args.areas, sys.args.routes)
+    connect.init ()
+
+    log (INFO, 'querying %s for route relations in areas ...' % sys.args.source)
+    osm_relations = connect.source.relations_in_areas (sys.args.areas, sys.args.routes)
     log (INFO, 'got %d route relations from overpass' % len (osm_relations))
 
     geokatalog.init (osm_relations, sys.args.geokatalog)
 
+    store = None
+    if sys.args.incremental:
+        store = ResultStore (sys.args.incremental, [
+            sorted (sys.args.areas), sorted (sys.args.routes), bool (sys.args.geokatalog), rules.digest
+        ])
+
     log (INFO, 'start checking OSM routes')
 
     checked_relations = 0
     faulty_relations = set ()
 
     def osm_route_key (i):
-        rtags = i[1]['rfull'][-1]['tags']
+        rtags = i[1]['properties']
         return connect.natural_sort (rtags.get ('ref', rtags.get ('name', '')))
 
-    for rel_id, osm_route in sorted (geokatalog.osm_routes.items (), key = osm_route_key):
-        log (DEBUG, 'checking OSM route %s' % rel_id)
+    rel_ids = [ rel_id for rel_id, osm_route in sorted (geokatalog.osm_routes.items (), key = osm_route_key)
+                if rel_id not in sys.args.osm_ignore ]
 
-        errors = []
-        if rel_id in sys.args.osm_ignore:
-            continue
+    for rel_id, (errors, checked, tb) in zip (rel_ids, incremental_checks (
+            'osm', check_osm_route, rel_ids, geokatalog.osm_inputs)):
+        log (DEBUG, 'checked OSM route %s' % rel_id)
 
-        try:
-            rfull = osm_route['rfull']
-            relation = rfull[-1]
-            rtags = relation['tags']
-            context = connect.format_route (relation)
-
-            route = get_route_type (rtags)
-            if route not in connect.CHECKED_TYPES:
-                continue
-
-            fixme = rtags.get ('fixme')
-            if fixme:
-                errors.append ((WARN, 'fixme: %s' % fixme))
-
-            check_route (rfull, errors)
+        if checked:
             checked_relations += 1
 
-            # check against geokatalog
-
-            if (sys.args.geokatalog
-                and rtags['type'] == 'route'  # not abandoned etc.
-                and route in connect.HIKING_TYPES
-                and 'buffered' in osm_route
-                and not re.match (r'E|O|SI|VA', rtags.get ('ref', ''))
-                and not 'via_ferrata_scale' in rtags
-                and not rtags.get ('hiking') == 'via_ferrata'):
+        context = connect.format_route (geokatalog.osm_routes[rel_id]['relation'])
+        for level, error in errors:
+            if level == ERROR and rel_id in sys.args.osm_warn:
+                level = WARN
+            log (level, "%s - %s" % (context, error))
 
-                geokatalog.check_osm_covered (rel_id, errors)
-
-            if errors:
-                for level, error in errors:
-                    if level == ERROR and rel_id in sys.args.osm_warn:
-                        level = WARN
-                    log (level, "%s - %s" % (context, error))
-
-        except Exception as e:
-            traceback.print_exc (file=sys.stdout)
+        if tb:
+            sys.stdout.write (tb)
 
     log (INFO, 'Checked relations: %d' % checked_relations)
     log (INFO, 'Faulty relations:  %d' % len (faulty_relations))
@@ -462,12 +625,12 @@ if __name__ == '__main__':
         props = i[1]['properties']
         return connect.natural_sort (props.get ('WEGENR', props.get ('ROUTENNAME', '')))
 
-    for gk_id, gk_route in sorted (geokatalog.gk_routes.items (), key = gk_route_key):
-        errors = []
-        if 'buffered' in gk_route:
-            geokatalog.check_geokatalog_covered (gk_id, errors)
+    gk_ids = [ gk_id for gk_id, gk_route in sorted (geokatalog.gk_routes.items (), key = gk_route_key) ]
+
+    for gk_id, errors in zip (gk_ids, incremental_checks (
+            'gk', check_gk_route, gk_ids, geokatalog.gk_inputs)):
         if errors:
-            gk_props = gk_route['properties']
+            gk_props = geokatalog.gk_routes[gk_id]['properties']
             gk_ref   = gk_props.get ('WEGENR',     '')
             gk_name  = gk_props.get ('ROUTENNAME', '')
 
@@ -1,16 +1,30 @@
 #!/usr/bin/python3
 
+import asyncio
+import collections
+import hashlib
+import json
 import logging
 from logging import ERROR, WARN, INFO, DEBUG
+import os
 from pathlib import Path
 import pprint
+import queue
 import re
+import sqlite3
 import sys
+import threading
+import time
+import zlib
 from multiprocessing import Pool
 
+import aiohttp
+import numpy
+import osmapi
 import requests
-# import osmapi
+import sqlalchemy
 
+import shapely
 import shapely.ops
 from shapely.geometry import MultiLineString, LineString, MultiPoint, Point, MultiPolygon, Polygon, LinearRing, box
 from shapely import wkt, wkb
@@ -66,28 +80,28 @@ WAY_TAGS = set ((
 def way_is_way (way, clip_exceptions = False):
     # only consider these kinds of ways
 
-    wtags = way.get ('tags')
+    wtags = way.tags
     if clip_exceptions and 'geokatalog:exception' in wtags:
         return False
 
-    return wtags and WAY_TAGS.intersection (wtags.keys ())
+    return bool (WAY_TAGS.intersection (wtags.keys ()))
 
 
 def way_is_area (way):
     # check if the way should be treated as area
     # in an area all points are valid entry and exit points
-    wtags  = way.get ('tags')
-    wnodes = way.get ('nodes')
+    wtags  = way.tags
+    wnodes = way.nodes
 
-    area       = wtags and wtags.get ('area', '') == 'yes'
-    roundabout = wtags and wtags.get ('junction', '') in ('roundabout', 'circular')
+    area       = wtags.get ('area', '') == 'yes'
+    roundabout = wtags.get ('junction', '') in ('roundabout', 'circular')
     closed     = wnodes[0] == wnodes[-1]
     return closed and (area or roundabout)
 
 
 def format_route (relation):
-    rtags  = relation['tags']
-    rel_id = relation['id']
+    rtags  = relation.tags
+    rel_id = relation.id
 
     route = rtags.get ('route', '')
     ref   = rtags.get ('ref', '')
@@ -129,14 +143,99 @@ def format_gk_route (props):
 #    ]
 # }
 
+OSM_API  = 'https://api.openstreetmap.org/api/0.6/'
+OVERPASS = 'http://overpass-api.de/api/interpreter'
+
+USER_AGENT = 'hikemap route checker'
+
+session = requests.Session ()
+""" HTTP keep-alive session for all requests. """
+session.headers['User-Agent'] = USER_AGENT
+
+cache = None
+""" The :class:`OsmCache` or None. """
+
+
+class OsmCache ():
+    """A persistent cache for OSM API and Overpass responses.
+
+    The entries are keyed by strings like 'relation/123/full' and remember the
+    version of the element, the HTTP ETag and the time of the last fetch.
+
+    The cache is an SQLite file that can be shared by all runs.  Every process
+    and thread opens its own connection, so the cache may be used from Pool
+    workers and from the fetcher thread.
+
+    """
+
+    def __init__ (self, filename, max_age = 86400, offline = False):
+        self.filename = filename
+        self.max_age  = max_age
+        self.offline  = offline
+        self.conns    = dict ()
+
+    def db (self):
+        key = (os.getpid (), threading.get_ident ())
+        if key not in self.conns:
+            conn = sqlite3.connect (self.filename, timeout = 60, isolation_level = None)
+            conn.execute ('PRAGMA journal_mode = WAL')
+            conn.execute ("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key     TEXT PRIMARY KEY,
+                version INTEGER,
+                etag    TEXT,
+                fetched REAL,
+                body    BLOB
+            )
+            """)
+            self.conns[key] = conn
+        return self.conns[key]
+
+    def get (self, key):
+        """ Return (version, etag, age, data) or None. """
+
+        row = self.db ().execute (
+            'SELECT version, etag, fetched, body FROM cache WHERE key = ?', (key, )
+        ).fetchone ()
+        if row is None:
+            return None
+        version, etag, fetched, body = row
+        return version, etag, time.time () - fetched, json.loads (zlib.decompress (body))
+
+    def put (self, key, version, etag, data):
+        self.db ().execute (
+            'INSERT OR REPLACE INTO cache (key, version, etag, fetched, body) VALUES (?, ?, ?, ?, ?)',
+            (key, version, etag, time.time (), zlib.compress (json.dumps (data, default = str).encode ('utf-8')))
+        )
+
+    def touch (self, key):
+        self.db ().execute ('UPDATE cache SET fetched = ? WHERE key = ?', (time.time (), key))
+
+
+def init_cache (filename, max_age, offline):
+    if filename:
+        os.makedirs (os.path.dirname (filename) or '.', exist_ok = True)
+    connect.cache = OsmCache (filename, max_age, offline) if filename else None
+
+
 def query (q):
-    url = "http://overpass-api.de/api/interpreter"
+    url = OVERPASS
     q   = "[out:json];\n\n%s" % q
 
-    r = requests.post (url, data = {'data' : q})
+    key = 'overpass/' + hashlib.sha1 (q.encode ('utf-8')).hexdigest ()
+    entry = cache.get (key) if cache else None
+    if entry and (cache.offline or entry[2] < cache.max_age):
+        return entry[3]
+    if cache and cache.offline:
+        raise LookupError ('Overpass query not in cache (offline)')
+
+    r = session.post (url, data = {'data' : q})
     r.raise_for_status ()
 
-    return r.json ().get ('elements', [])
+    elements = r.json ().get ('elements', [])
+    if cache:
+        cache.put (key, None, None, elements)
+    return elements
 
 
 def relations_in_areas (area_ids, types = CHECKED_TYPES):
@@ -149,34 +248,144 @@ def relations_in_areas (area_ids, types = CHECKED_TYPES):
         relation["route"~"{types}"](area.location);
         relation["abandoned:route"~"{types}"](area.location);
     );
-    out ids;
+    out meta;
     """.format (areas = areas, types = types)
 
     return query (q)
 
 
-def osm_relation_as_multilinestring (rfull, clip_exceptions = False):
-    """ Return an OSM relations as multilinestring.
+class Node ():
+    __slots__ = ('id', 'version', 'tags', 'lon', 'lat')
+
+    def __init__ (self, e):
+        self.id      = e['id']
+        self.version = e.get ('version')
+        self.tags    = e.get ('tags') or NO_TAGS
+        self.lon     = e['lon']
+        self.lat     = e['lat']
+
+
+class Way ():
+    __slots__ = ('id', 'version', 'tags', 'nodes')
+
+    def __init__ (self, e):
+        self.id      = e['id']
+        self.version = e.get ('version')
+        self.tags    = e.get ('tags') or NO_TAGS
+        self.nodes   = tuple (e['nodes'])
+
+
+Member = collections.namedtuple ('Member', 'type ref role')
+
+
+class Relation ():
+    __slots__ = ('id', 'version', 'tags', 'members')
+
+    def __init__ (self, e):
+        self.id      = e['id']
+        self.version = e.get ('version')
+        self.tags    = e.get ('tags') or NO_TAGS
+        self.members = tuple ([ Member (m['type'], m['ref'], m['role']) for m in e['members'] ])
+
+    def member_refs (self, type_, roles = None):
+        """ Return the ids of the members of type_, optionally with one of roles. """
+        return [ m.ref for m in self.members if m.type == type_ and (roles is None or m.role in roles) ]
+
+
+NO_TAGS = dict ()
+""" Shared by all untagged elements.  Don't modify. """
+
+
+class ElementStore ():
+    """Holds the OSM elements of all relations we know, deduplicated by id.
+
+    Nodes and ways shared by many routes are stored only once, as compact
+    slotted objects.  The routes reference their members by id.  If an
+    element comes in with different versions, the newest one is kept.
 
-    Optionally remove ways marked as exceptions.
     """
 
-    try:
-        relation = rfull[-1]
+    CLASSES = { 'node' : Node, 'way' : Way, 'relation' : Relation }
+
+    def __init__ (self):
+        self.nodes     = dict ()
+        self.ways      = dict ()
+        self.relations = dict ()
+        self.by_type   = { 'node' : self.nodes, 'way' : self.ways, 'relation' : self.relations }
+
+    def add (self, elements):
+        """ Add the elements of a `relation/#id/full` call.  Returns the relation. """
+
+        for e in elements:
+            d = self.by_type[e['type']]
+            old = d.get (e['id'])
+            if old is None or (old.version or 0) < (e.get ('version') or 0):
+                d[e['id']] = self.CLASSES[e['type']] (e)
+        return self.relations[elements[-1]['id']]
+
+    def member_ways (self, relation, roles = None):
+        """ Return the member ways of the relation, in order. """
+        return [ self.ways[ref] for ref in relation.member_refs ('way', roles) ]
+
+    def member_nodes (self, relation, roles = None):
+        """ Return the member nodes of the relation, in order. """
+        return [ self.nodes[ref] for ref in relation.member_refs ('node', roles) ]
+
+    def versions (self, relation):
+        """ Return the versions of the relation and all its member elements. """
+
+        versions = [ ('relation', relation.id, relation.version) ]
+        for m in relation.members:
+            e = self.by_type[m.type].get (m.ref)
+            if e is not None:
+                versions.append ((m.type, e.id, e.version))
+                if m.type == 'way':
+                    versions.extend ([ ('node', n, getattr (self.nodes.get (n), 'version', None)) for n in e.nodes ])
+        return versions
+
+
+store = ElementStore ()
+""" The elements of all relations we know. """
+
+
+def ways_as_linestrings (store, ways, transformer = None):
+    """Return the ways as an array of linestrings.
+
+    All node coordinates go into one array and are projected with one call to
+    the transformer, if given.  Every way must have at least 2 nodes.
+
+    """
+
+    if not ways:
+        return numpy.empty (0, dtype = object)
+
+    nodes = store.nodes
+    count = sum ([ len (w.nodes) for w in ways ])
+
+    parts = numpy.repeat (numpy.arange (len (ways)), [ len (w.nodes) for w in ways ])
+    x = numpy.fromiter ((nodes[n].lon for w in ways for n in w.nodes), dtype = numpy.float64, count = count)
+    y = numpy.fromiter ((nodes[n].lat for w in ways for n in w.nodes), dtype = numpy.float64, count = count)
+    if transformer is not None:
+        x, y = transformer.transform (x, y)
+
+    return shapely.linestrings (x, y, indices = parts)
+
+
+def osm_relation_as_multilinestring (store, relation, clip_exceptions = False, transformer = None):
+    """ Return an OSM relations as multilinestring.
 
-        nodes_dict = dict ([(n['id'], n) for n in rfull if n['type'] == 'node'])
-        ways_dict  = dict ([(w['id'], w) for w in rfull if w['type'] == 'way'])
+    Optionally remove ways marked as exceptions.  Optionally project the
+    coordinates with transformer.
+    """
 
-        ways = [ ways_dict[m['ref']] for m in relation['members'] if m['type'] == 'way' ]
+    try:
+        ways = store.member_ways (relation)
+        ways = [ w for w in ways if way_is_way (w, clip_exceptions) and len (w.nodes) > 1 ]
 
-        lines = []
-        for way in ways:
-            if way_is_way (way, clip_exceptions):
-                nodes = way['nodes']
-                lines.append (LineString ([ (nodes_dict[n]['lon'], nodes_dict[n]['lat']) for n in nodes ]))
+        lines = ways_as_linestrings (store, ways, transformer)
 
-        mls = shapely.ops.linemerge (lines)
-        if mls.type == 'LineString':
+        mls = shapely.line_merge (shapely.multilinestrings (lines))
+        if mls.geom_type == 'LineString':
             return MultiLineString ([mls])
         return mls
     except KeyError:
@@ -186,23 +395,18 @@ def osm_relation_as_multilinestring (rfull, clip_exceptions = False):
 
 def get_area (area_id):
     area_id = int (area_id)
-    rfull = relation_full (area_id)
-    relation = rfull[-1]
+    rfull = source.relation_full (area_id)
+    area_store = ElementStore ()
+    relation = area_store.add (rfull)
     # log (DEBUG, "relation %s" % relation)
 
-    nodes_dict = dict ([(n['id'], n) for n in rfull if n['type'] == 'node'])
-    ways_dict  = dict ([(w['id'], w) for w in rfull if w['type'] == 'way'])
-
-    ways = [ m['ref'] for m in relation['members'] if m['type'] == 'way' and m['role'] == 'outer' ]
-    lines = []
-    for way in ways:
-        nodes = [ nodes_dict[n] for n in ways_dict[way]['nodes'] ]
-        ls = LineString ([ (n['lon'], n['lat']) for n in nodes ])
-        assert ls.is_simple, "way %d is not simple" % way
-        lines.append (ls)
+    ways = area_store.member_ways (relation, ('outer', ))
+    lines = ways_as_linestrings (area_store, ways)
+    for way, ls in zip (ways, lines):
+        assert ls.is_simple, "way %d is not simple" % way.id
 
-    ls = shapely.ops.linemerge (lines)
-    assert ls.type == 'LineString', "Area %d is not a LineString" % area_id
+    ls = shapely.line_merge (shapely.multilinestrings (lines))
+    assert ls.geom_type == 'LineString', "Area %d is not a LineString" % area_id
     assert ls.is_simple,            "Area %d is not simple" % area_id
     assert ls.is_ring,              "Area %d is not a ring" % area_id
 
@@ -212,30 +416,711 @@ def get_area (area_id):
     #log (DEBUG, "cuts: %s"     % cuts.wkt[:1000])
     #log (DEBUG, "invalids: %s" % invalids.wkt[:1000])
 
-    polys = list (result)
+    polys = list (result.geoms)
 
     assert len (polys) == 1, "Area %d must have 1 polygon (but has %d instead)" % (area_id, len (polys))
     return polys
 
 
-def relation_full (rel_id):
-    url = 'https://api.openstreetmap.org/api/0.6/relation/{rel_id}/full.json'
-    r = requests.get (url.format (rel_id = rel_id))
+def cached_area (area_id, versions = None):
+    """Return the WKB of an area from the cache, or None.
+
+    The cached polygon is good if it was built from the current version of the
+    area relation.  The version is only checked after the max. age of the cache.
+    versions is a dict of the current versions of the area relations, if known.
+
+    """
+
+    if cache is None:
+        return None
+    key = 'area/%d' % area_id
+    entry = cache.get (key)
+    if entry is None:
+        return None
+    version, etag, age, data = entry
+    if not (cache.offline or age < cache.max_age):
+        if versions is None:
+            versions = source.relation_versions ([area_id])
+        if versions.get (area_id) != version:
+            return None
+        cache.touch (key)
+    return bytes.fromhex (data)
+
+
+def build_area (area_id):
+    """ Build the polygon of an area and cache it.  Returns the WKB. """
+
+    data = shapely.to_wkb (get_area (area_id)[0])
+    if cache:
+        cache.put ('area/%d' % area_id, source.relation_version (area_id), None, data.hex ())
+    return data
+
+
+def init_areas ():
+    """Get the polygons of the areas and build the indices over them.
+
+    The polygons come from the cache or are built in a process pool.  Called by
+    :func:`__getattr__` the first time one of the area attributes is used.
+
+    """
+
+    # check the versions of all stale areas in one go
+    versions = dict ()
+    if cache is not None and not cache.offline:
+        stale = []
+        for area_id in area_ids:
+            entry = cache.get ('area/%d' % area_id)
+            if entry is not None and entry[2] >= cache.max_age:
+                stale.append (area_id)
+        if stale:
+            versions = source.relation_versions (stale)
+
+    wkbs = dict ([ (area_id, cached_area (area_id, versions)) for area_id in area_ids ])
+    todo = [ area_id for area_id, data in wkbs.items () if data is None ]
+    if todo:
+        source.prefetch (todo)
+        with Pool () as p:
+            wkbs.update (zip (todo, tqdm (
+                p.imap (build_area, todo),
+                total = len (todo),
+                desc = 'Areas'
+            )))
+
+    connect.areas = shapely.from_wkb ([ wkbs[area_id] for area_id in area_ids ])
+    connect.area_tree = shapely.STRtree (areas)
+    connect.boundary = shapely.union_all (areas)
+    shapely.prepare (boundary)
+
+
+AREA_ATTRIBUTES = ('areas', 'area_tree', 'boundary')
+""" The module attributes that are built lazily by :func:`init_areas`. """
+
+
+def __getattr__ (name):
+    if name in AREA_ATTRIBUTES:
+        init_areas ()
+        return globals ()[name]
+    raise AttributeError ('module %r has no attribute %r' % (__name__, name))
+
+
+def lookup_relation (rel_id, version = None):
+    """Look up a relation in the cache.
+
+    A cached copy is used if it has the requested version, or, if no version is
+    requested, if it is younger than the max. age of the cache.  Else the copy
+    must be revalidated with the server.  Edits to member ways that do not bump
+    the version of the relation are thus only seen after the max. age.
+
+    Returns the elements if the cached copy is good, else None and the headers
+    for a conditional request.
+
+    """
+
+    entry = cache.get ('relation/%d/full' % rel_id) if cache else None
+    if entry:
+        cached_version, etag, age, elements = entry
+        if cache.offline or (version is not None and version == cached_version):
+            return elements, {}
+        if version is None and age < cache.max_age:
+            return elements, {}
+    if cache and cache.offline:
+        raise LookupError ('relation %d not in cache (offline)' % rel_id)
+
+    headers = {}
+    if entry and entry[1] and (version is None or version == entry[0]):
+        headers['If-None-Match'] = entry[1]
+    return None, headers
+
+
+def store_relation (rel_id, elements, etag):
+    if cache:
+        cache.put ('relation/%d/full' % rel_id, elements[-1].get ('version'), etag, elements)
+
+
+def relation_full (rel_id, version = None):
+    """ Get a relation and all its members from the OSM API. """
+
+    elements, headers = lookup_relation (rel_id, version)
+    if elements is not None:
+        return elements
+
+    url = OSM_API + 'relation/{rel_id}/full.json'
+    r = session.get (url.format (rel_id = rel_id), headers = headers)
+    if r.status_code == 304:
+        cache.touch ('relation/%d/full' % rel_id)
+        return cache.get ('relation/%d/full' % rel_id)[3]
     r.raise_for_status ()
 
-    return r.json ()['elements']
+    elements = r.json ()['elements']
+    store_relation (rel_id, elements, r.headers.get ('ETag'))
+    return elements
+
+
+async def _fetch_relation (http, semaphore, rel_id, version, retries):
+    """ Fetch one relation, retry with exponential backoff on 429 and 5xx. """
+
+    elements, headers = lookup_relation (rel_id, version)
+    if elements is not None:
+        return rel_id, elements
+
+    url = OSM_API + 'relation/{rel_id}/full.json'.format (rel_id = rel_id)
+    delay = 1.0
+    for attempt in range (retries + 1):
+        async with semaphore:
+            async with http.get (url, headers = headers) as r:
+                if r.status == 304:
+                    cache.touch ('relation/%d/full' % rel_id)
+                    return rel_id, cache.get ('relation/%d/full' % rel_id)[3]
+                if r.status == 410:
+                    # relation deleted
+                    return rel_id, None
+                if r.status != 429 and r.status < 500:
+                    r.raise_for_status ()
+                    elements = (await r.json (content_type = None))['elements']
+                    store_relation (rel_id, elements, r.headers.get ('ETag'))
+                    return rel_id, elements
+                try:
+                    wait = float (r.headers.get ('Retry-After', delay))
+                except ValueError:
+                    wait = delay
+        log (DEBUG, 'HTTP %d on relation %d, retrying in %.1fs' % (r.status, rel_id, wait))
+        await asyncio.sleep (wait)
+        delay *= 2
+
+    raise RuntimeError ('giving up on relation %d after %d retries' % (rel_id, retries))
+
+
+async def _fetch_relations (rel_ids, versions, concurrency, retries, on_result, progress = True):
+    semaphore = asyncio.Semaphore (concurrency)
+    connector = aiohttp.TCPConnector (limit = concurrency) # keep-alive is default
+
+    async with aiohttp.ClientSession (connector = connector, headers = session.headers) as http:
+        tasks = [ _fetch_relation (http, semaphore, rel_id, versions.get (rel_id), retries) for rel_id in rel_ids ]
+        for f in tqdm (asyncio.as_completed (tasks), total = len (tasks), desc = 'OSM API', disable = not progress):
+            on_result (await f)
+
+
+def fetch_relations (rel_ids, versions = {}, concurrency = 8, retries = 5):
+    """Fetch many relations from the OSM API concurrently.
+
+    Uses one keep-alive session with at most `concurrency` requests in flight.
+
+    Returns a dict of relation id to element list, or to None if the relation
+    was deleted.
+
+    """
+
+    results = dict ()
+
+    def on_result (result):
+        results[result[0]] = result[1]
+
+    asyncio.run (_fetch_relations (rel_ids, versions, concurrency, retries, on_result))
+    return results
+
+
+def iter_relations (rel_ids, versions = {}, concurrency = 8, retries = 5):
+    """Fetch many relations from the OSM API concurrently.
+
+    Like :func:`fetch_relations` but yields (relation id, elements) as soon as
+    each relation arrives.  The fetcher runs in its own thread.
+
+    """
+
+    q = queue.Queue ()
+
+    def run ():
+        try:
+            asyncio.run (_fetch_relations (rel_ids, versions, concurrency, retries, q.put, False))
+        except Exception as e:
+            q.put (e)
+        q.put (None)
+
+    thread = threading.Thread (target = run, daemon = True)
+    thread.start ()
+    while True:
+        item = q.get ()
+        if item is None:
+            break
+        if isinstance (item, Exception):
+            raise item
+        yield item
+    thread.join ()
+
+
+API_CHUNK_SIZE = 100
+""" Max. no. of ids in one multi-fetch request.  Keeps the URL short enough. """
+
+api = None
+""" The osmapi.OsmApi or None. """
+
+
+def init_api (passwordfile = '~/.osmpass', url = None):
+    """Open the OSM API.  Without a password file the API is read-only.
+
+    url is the base url of another API server, eg. the mock server in
+    :file:`mock_osm_api.py`.
+
+    """
+
+    kwargs = dict ()
+    if url:
+        kwargs['api'] = url.rstrip ('/')
+        connect.OSM_API = kwargs['api'] + '/api/0.6/'
+
+    passwordfile = Path (passwordfile).expanduser ()
+    if passwordfile.exists ():
+        kwargs['passwordfile'] = passwordfile
+    connect.api = osmapi.OsmApi (**kwargs)
+
+
+def _get_chunk (fetch, ids):
+    """Multi-fetch a chunk of elements.
+
+    The API fails the whole request with 404 if one element never existed.  In
+    that case split the chunk until we find the culprit.
+
+    """
+
+    try:
+        return fetch (ids)
+    except osmapi.ElementNotFoundApiError:
+        if len (ids) == 1:
+            return dict ()
+        half = len (ids) // 2
+        res = _get_chunk (fetch, ids[:half])
+        res.update (_get_chunk (fetch, ids[half:]))
+        return res
+
+
+def get_elements (kind, ids, max_age = None):
+    """Get elements from the OSM API in batches.
+
+    kind is 'node', 'way' or 'relation'.  Elements younger than max_age (the max.
+    age of the cache by default) are served from the cache.  The others are
+    fetched with the multi-fetch calls in chunks of :data:`API_CHUNK_SIZE`.
+
+    Returns a dict of id to element in osmapi format.  Deleted elements are
+    missing in the result.
+
+    """
+
+    fetch = {
+        'node'     : api.NodesGet,
+        'way'      : api.WaysGet,
+        'relation' : api.RelationsGet,
+    }[kind]
+
+    result = dict ()
+    todo   = []
+
+    for id_ in sorted (set (ids)):
+        entry = cache.get ('%s/%d' % (kind, id_)) if cache else None
+        if entry and (cache.offline or entry[2] < (cache.max_age if max_age is None else max_age)):
+            if entry[3] is not None:
+                result[id_] = entry[3]
+            continue
+        todo.append (id_)
+
+    if todo and cache and cache.offline:
+        raise LookupError ('%d %ss not in cache (offline)' % (len (todo), kind))
+
+    for i in range (0, len (todo), API_CHUNK_SIZE):
+        chunk = todo[i:i + API_CHUNK_SIZE]
+        elements = _get_chunk (fetch, chunk)
+        for id_ in chunk:
+            data = elements.get (id_)
+            if data is not None and not data.get ('visible', True):
+                data = None # deleted
+            if cache:
+                cache.put ('%s/%d' % (kind, id_), data and data.get ('version'), None, data)
+            if data is not None:
+                result[id_] = data
+
+    return result
+
+
+def get_ways (way_ids, max_age = None):
+    """ Get ways from the OSM API in batches. """
+    return get_elements ('way', way_ids, max_age)
+
+
+def get_relations (rel_ids, max_age = None):
+    """ Get relations from the OSM API in batches. """
+    return get_elements ('relation', rel_ids, max_age)
+
+
+def _parent_relations (kind, id_, max_age):
+    """ Get the relations that have the element as member, from the cache or the API. """
+
+    key = '%s/%d/relations' % (kind, id_)
+    entry = cache.get (key) if cache else None
+    if entry and (cache.offline or entry[2] < (cache.max_age if max_age is None else max_age)):
+        return list (get_relations (entry[3], max_age).values ())
+    if cache and cache.offline:
+        raise LookupError ('parent relations of %s %d not in cache (offline)' % (kind, id_))
+
+    fetch = {
+        'way'      : api.WayRelations,
+        'relation' : api.RelationRelations,
+    }[kind]
+    try:
+        relations = [ r for r in fetch (id_) if r.get ('visible', True) ]
+    except osmapi.XmlResponseInvalidError:
+        relations = [] # no parent relations
+    if cache:
+        cache.put (key, None, None, [ r['id'] for r in relations ])
+        for r in relations:
+            cache.put ('relation/%d' % r['id'], r['version'], None, r)
+    return relations
+
+
+def get_parent_relations (kind, ids, max_age = None):
+    """Get the live relations that contain the elements, directly or through super relations.
+
+    kind is 'way' or 'relation'.  The API has no multi-fetch for this, so it
+    costs one call per element and per parent relation.  Returns a dict of id
+    to list of relations in osmapi format.
+
+    """
+
+    parents = dict ()
+    def get (kind, id_):
+        if (kind, id_) not in parents:
+            parents[(kind, id_)] = _parent_relations (kind, id_, max_age)
+        return parents[(kind, id_)]
+
+    result = dict ()
+    for id_ in ids:
+        found = dict ()
+        todo = get (kind, id_)
+        while todo:
+            r = todo.pop ()
+            if r['id'] not in found:
+                found[r['id']] = r
+                todo.extend (get ('relation', r['id']))
+        result[id_] = list (found.values ())
+    return result
+
+
+class ApiSource ():
+    """ Get OSM data from the OSM API and Overpass. """
+
+    def __init__ (self, concurrency = 8):
+        self.rfulls = dict ()
+        self.concurrency = concurrency
+
+    def prefetch (self, rel_ids, versions = {}):
+        rel_ids = [ int (i) for i in rel_ids if int (i) not in self.rfulls ]
+        if rel_ids:
+            self.rfulls.update (fetch_relations (rel_ids, versions, self.concurrency))
+
+    def iter_relations_full (self, rel_ids, versions = {}):
+        """ Yield (relation id, elements) as the relations arrive. """
+
+        rel_ids = [ int (i) for i in rel_ids ]
+        for rel_id in rel_ids:
+            if rel_id in self.rfulls:
+                yield rel_id, self.rfulls[rel_id]
+        yield from iter_relations (
+            [ i for i in rel_ids if i not in self.rfulls ], versions, self.concurrency
+        )
+
+    def relation_full (self, rel_id, version = None):
+        if rel_id in self.rfulls:
+            if self.rfulls[rel_id] is None:
+                raise LookupError ('relation %d was deleted' % rel_id)
+            return self.rfulls[rel_id]
+        return relation_full (rel_id, version)
+
+    def relation_version (self, rel_id):
+        if rel_id in self.rfulls:
+            return self.relation_full (rel_id)[-1]['version']
+        version = self.relation_versions ([rel_id]).get (rel_id)
+        if version is None:
+            raise LookupError ('relation %d was deleted' % rel_id)
+        return version
+
+    def relation_versions (self, rel_ids):
+        """ Return a dict of relation id to current version.  Deleted relations are missing. """
+
+        if api is None:
+            init_api ()
+        return dict ([ (id_, r['version']) for id_, r in get_relations (rel_ids, 0).items () ])
+
+    def relations_in_areas (self, area_ids, types = CHECKED_TYPES):
+        return relations_in_areas (area_ids, types)
+
+
+class DbSource ():
+    """Get OSM data from the snapshot schema in the local database.
+
+    Assembles the same element lists as the OSM API call `relation/#id/full`,
+    with the relation itself last.  Call :meth:`prefetch` with all relation ids
+    before forking, then the data of all relations is read in a few set-based
+    queries and the workers inherit it.  Or stream the relations in chunks with
+    :meth:`iter_relations_full`.
+
+    """
+
+    def __init__ (self):
+        self.rfulls = dict ()
+        self.engine = None
+        self.pid    = None
+
+    def conn (self):
+        if self.pid != os.getpid ():
+            self.engine = get_engine ()
+            self.pid    = os.getpid ()
+        return self.engine.connect ()
+
+    @staticmethod
+    def tagged (element, tags):
+        # the OSM API omits empty tags
+        if tags:
+            element['tags'] = tags
+        return element
+
+    CHUNK_SIZE = 250
+    """ No. of relations to read at once when streaming. """
+
+    def prefetch (self, rel_ids, versions = {}):
+        rel_ids = [ int (i) for i in rel_ids if int (i) not in self.rfulls ]
+        if rel_ids:
+            self.rfulls.update (self.read (rel_ids))
+
+    def iter_relations_full (self, rel_ids, versions = {}):
+        """ Yield (relation id, elements), reading the relations in chunks. """
+
+        rel_ids = [ int (i) for i in rel_ids ]
+        for n in range (0, len (rel_ids), self.CHUNK_SIZE):
+            chunk = rel_ids[n:n + self.CHUNK_SIZE]
+            rfulls = self.read ([ i for i in chunk if i not in self.rfulls ])
+            for rel_id in chunk:
+                yield rel_id, self.rfulls.get (rel_id, rfulls.get (rel_id))
+
+    def read (self, rel_ids):
+        """ Read the relations from the database. Return a dict of id to elements. """
+
+        rfulls = dict ()
+        if not rel_ids:
+            return rfulls
+
+        with self.conn () as conn:
+            members = collections.defaultdict (list)
+
+            def get_members (ids):
+                res = conn.execute (sqlalchemy.text ("""
+                SELECT relation_id, member_id, member_type, member_role
+                FROM snapshot.relation_members
+                WHERE relation_id = ANY (:ids)
+                ORDER BY relation_id, sequence_id
+                """), { 'ids' : ids })
+                for rel_id, member_id, member_type, role in res:
+                    members[rel_id].append ({
+                        'type' : MEMBER_TYPES[member_type],
+                        'ref'  : member_id,
+                        'role' : role,
+                    })
+
+            # the relations and their member relations
+            get_members (rel_ids)
+            sub_ids = set ([ m['ref'] for i in rel_ids for m in members[i] if m['type'] == 'relation' ])
+            get_members (list (sub_ids - set (rel_ids)))
+
+            relations = dict ()
+            res = conn.execute (sqlalchemy.text ("""
+            SELECT id, version, hstore_to_json (tags)
+            FROM snapshot.relations
+            WHERE id = ANY (:ids)
+            """), { 'ids' : list (set (rel_ids) | sub_ids) })
+            for id_, version, tags in res:
+                relations[id_] = self.tagged ({
+                    'type'    : 'relation',
+                    'id'      : id_,
+                    'version' : version,
+                    'members' : members[id_],
+                }, tags)
+
+            ways = dict ()
+            res = conn.execute (sqlalchemy.text ("""
+            SELECT id, version, hstore_to_json (tags), nodes
+            FROM snapshot.ways
+            WHERE id IN (
+              SELECT member_id
+              FROM snapshot.relation_members
+              WHERE relation_id = ANY (:ids) AND member_type = 'W'
+            )
+            """), { 'ids' : rel_ids })
+            for id_, version, tags, nodes in res:
+                ways[id_] = self.tagged ({
+                    'type'    : 'way',
+                    'id'      : id_,
+                    'version' : version,
+                    'nodes'   : nodes,
+                }, tags)
+
+            nodes = dict ()
+            res = conn.execute (sqlalchemy.text ("""
+            SELECT id, version, hstore_to_json (tags), ST_X (geom), ST_Y (geom)
+            FROM snapshot.nodes
+            WHERE id IN (
+              SELECT unnest (w.nodes)
+              FROM snapshot.ways w
+                JOIN snapshot.relation_members rm ON (rm.member_id, rm.member_type) = (w.id, 'W')
+              WHERE rm.relation_id = ANY (:ids)
+            UNION
+              SELECT member_id
+              FROM snapshot.relation_members
+              WHERE relation_id = ANY (:ids) AND member_type = 'N'
+            )
+            """), { 'ids' : rel_ids })
+            for id_, version, tags, lon, lat in res:
+                nodes[id_] = self.tagged ({
+                    'type'    : 'node',
+                    'id'      : id_,
+                    'version' : version,
+                    'lat'     : lat,
+                    'lon'     : lon,
+                }, tags)
+
+        for rel_id in rel_ids:
+            if rel_id not in relations:
+                continue
+            relation = relations[rel_id]
+            rways  = [ ways[m['ref']] for m in relation['members'] if m['type'] == 'way' and m['ref'] in ways ]
+            rnodes = set ([ n for w in rways for n in w['nodes'] ])
+            rnodes |= set ([ m['ref'] for m in relation['members'] if m['type'] == 'node' ])
+            rrels  = [ relations[m['ref']] for m in relation['members']
+                       if m['type'] == 'relation' and m['ref'] in relations ]
+
+            rfulls[rel_id] = (
+                [ nodes[n] for n in sorted (rnodes) if n in nodes ] +
+                list ({ w['id'] : w for w in rways }.values ()) +
+                rrels +
+                [ relation ]
+            )
+
+        return rfulls
+
+    def relation_full (self, rel_id, version = None):
+        self.prefetch ([rel_id])
+        if rel_id not in self.rfulls:
+            raise LookupError ('relation %d not in database' % rel_id)
+        return self.rfulls[rel_id]
+
+    def relation_version (self, rel_id):
+        version = self.relation_versions ([rel_id]).get (rel_id)
+        if version is None:
+            raise LookupError ('relation %d not in database' % rel_id)
+        return version
+
+    def relation_versions (self, rel_ids):
+        """ Return a dict of relation id to version.  Relations not in the database are missing. """
+
+        with self.conn () as conn:
+            return dict (conn.execute (sqlalchemy.text (
+                "SELECT id, version FROM snapshot.relations WHERE id = ANY (:ids)"
+            ), { 'ids' : [ int (i) for i in rel_ids ] }).fetchall ())
+
+    def relations_in_areas (self, area_ids, types = CHECKED_TYPES):
+        """ Return the relations with a member way inside the areas. """
+
+        with self.conn () as conn:
+            area_ids = ensure_areas (conn, area_ids)
+            res = conn.execute (sqlalchemy.text ("""
+            SELECT DISTINCT r.id, r.version
+            FROM snapshot.relations r
+              JOIN snapshot.relation_members rm ON (rm.relation_id, rm.member_type) = (r.id, 'W')
+              JOIN snapshot.ways w ON w.id = rm.member_id
+            WHERE (r.tags->'route' = ANY (:types) OR r.tags->'abandoned:route' = ANY (:types))
+              AND EXISTS (SELECT 1 FROM in_area (CAST (:areas AS BIGINT[])) a
+                          WHERE ST_Intersects (a.geom, w.linestring))
+            """), { 'types' : list (types), 'areas' : area_ids })
+
+            return [ { 'type' : 'relation', 'id' : id_, 'version' : version } for id_, version in res ]
+
+
+MEMBER_TYPES = { 'N' : 'node', 'W' : 'way', 'R' : 'relation' }
+""" Member types in the snapshot schema. """
+
+SOURCES = ('api', 'db')
+""" The data sources selectable with --source. """
+
+source = ApiSource ()
+""" The data source. """
+
+area_ids = ()
+""" The ids of the areas we check.  See :func:`init_areas`. """
+
+
+def get_engine ():
+    """ Connect to the local database. """
+
+    params = {
+        'host'     : os.environ.get ('PGHOST')     or 'localhost',
+        'port'     : os.environ.get ('PGPORT')     or '5432',
+        'database' : os.environ.get ('PGDATABASE') or 'osm',
+        'user'     : os.environ.get ('PGUSER')     or 'osm',
+    }
+
+    return sqlalchemy.create_engine (
+        "postgresql+psycopg2://{user}@{host}:{port}/{database}".format (**params)
+    )
+
+
+def ensure_areas (conn, area_ids):
+    """Make sure the polygons of the areas in the database are current.
+
+    Builds the polygons in the tables snapshot.areas and snapshot.area_parts
+    for all areas that are missing or whose relation changed.  After that you
+    can filter with the SQL function in_area ().  Returns the area ids as list
+    of int.
+
+    """
+
+    area_ids = [ int (i) for i in area_ids ]
+
+    with conn.begin ():
+        res = conn.execute (sqlalchemy.text ("""
+        SELECT r.id
+        FROM snapshot.relations r
+          LEFT JOIN snapshot.areas a ON a.area_id = r.id
+        WHERE r.id = ANY (CAST (:areas AS BIGINT[])) AND a.version IS DISTINCT FROM r.version
+        """), { 'areas' : area_ids })
+        stale = [ id_ for id_, in res ]
+
+        if stale:
+            log (INFO, 'building areas %s' % ' '.join ([ str (i) for i in stale ]))
+            conn.execute (sqlalchemy.text ("SELECT build_areas (CAST (:areas AS BIGINT[]))"),
+                          { 'areas' : stale })
+
+    return area_ids
+
+
+def areas_bbox (conn, area_ids):
+    """ Return the bounding box of the areas as (xmin, ymin, xmax, ymax). """
+
+    area_ids = ensure_areas (conn, area_ids)
+    return tuple (conn.execute (sqlalchemy.text ("""
+    SELECT ST_XMin (e), ST_YMin (e), ST_XMax (e), ST_YMax (e)
+    FROM (SELECT ST_Extent (geom) AS e FROM snapshot.areas WHERE area_id = ANY (CAST (:areas AS BIGINT[]))) AS t
+    """), { 'areas' : area_ids }).fetchone ())
 
 
 def init ():
     connect.log = logging.getLogger ().log
 
-    area_ids = tuple (sys.args.areas)
-    with Pool () as p:
-        polys = list (tqdm (
-            p.imap (get_area, area_ids),
-            total = len (area_ids),
-            desc = 'Areas'
-        ))
+    init_cache (getattr (sys.args, 'cache', None),
+                getattr (sys.args, 'cache_max_age', 86400),
+                getattr (sys.args, 'offline', False))
+
+    if getattr (sys.args, 'source', 'api') == 'db':
+        connect.source = DbSource ()
+    else:
+        connect.source = ApiSource (getattr (sys.args, 'concurrency', 8))
 
-    polys = [p for sublist in polys for p in sublist] # flatten list of lists
-    connect.boundary = shapely.ops.unary_union (polys)
+    # the area polygons are built on first use
+    connect.area_ids = tuple ([ int (i) for i in sys.args.areas ])
+    for name in AREA_ATTRIBUTES:
+        connect.__dict__.pop (name, None)
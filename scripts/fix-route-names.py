@@ -1,41 +1,67 @@
 #!/usr/bin/python3
 
-import os
-from pathlib import Path
-import re
+""" Fix the name, osmc:symbol and network of my route relations. """
+
+import argparse
 
-import osmapi
 import sqlalchemy
 
-params = {
-    'host'     : os.environ.get ('PGHOST')     or 'localhost',
-    'port'     : os.environ.get ('PGPORT')     or '5432',
-    'database' : os.environ.get ('PGDATABASE') or 'osm',
-    'user'     : os.environ.get ('PGUSER')     or 'osm',
-}
+import check_route_tags
+import connect
+import osm_upload
+import tag_rules
 
-engine = sqlalchemy.create_engine (
-    "postgresql+psycopg2://{user}@{host}:{port}/{database}".format (**params)
+parser = argparse.ArgumentParser (description = __doc__)
+parser.add_argument (
+    '-e', '--edit', action='store_true',
+    help='edit the OSM database',
+)
+parser.add_argument (
+    '--api', metavar='URL',
+    help='use this OSM API server, eg. a mock server (default=openstreetmap.org)',
+)
+parser.add_argument (
+    '--batch-size', dest="batch_size", type=int, default=10,
+    help='apply OSM edits in changesets of this size (default=10)',
 )
-conn = engine.connect ()
+parser.add_argument (
+    '--journal', metavar='FILENAME', default='data/fix-route-names.journal',
+    help='journal of the uploads, to resume an interrupted run (default=data/fix-route-names.journal)',
+)
+args = parser.parse_args ()
+
+rules = tag_rules.load ()
+
+conn = connect.get_engine ().connect ()
 
-api = osmapi.OsmApi (passwordfile = Path ("~/.osmpass").expanduser ())
-cs = None
-changes = 0
+connect.init_cache ('data/osm-cache.sqlite', 86400, False)
+connect.init_api (url = args.api)
+uploader = osm_upload.Uploader (connect.api, args.journal, args.batch_size)
+
+def new_symbol_for (ref):
+    return rules.symbol_template (ref) if ref else None
+
+# find the problems in the (maybe stale) local database, in bulk
+# skip rows if everything is fine
+# leave qa_findings alone, it holds the results of check_route_tags.py
+findings, params = check_route_tags.findings_query (conn, rules)
+with conn.begin ():
+    rows = conn.execute (sqlalchemy.text ("""
+    SELECT DISTINCT rel, route FROM ({findings}) f
+    WHERE fix IS NOT NULL AND rule IN ('name-ref-prefix', 'no-network', 'bogus-symbol', 'symbol-mismatch')
+    ORDER BY rel
+    """.format (findings = findings)), params).fetchall ()
+
+# get current content from api, in batches, we don't edit stale data
+relations = connect.get_relations ([ row[0] for row in rows ], 0)
 
-rows = conn.execute ("select rel, ref, name, network, symbol from check_routes order by ref")
 for row in rows:
-    # get (maybe stale) content from local database
-    rel, ref, name, network, symbol = row
-    new_symbol = "red:red:white_bar:{ref}:black".format (ref = ref)
+    rel, route = row
 
-    # continue to next row if everything is fine
-    if name is None and symbol == new_symbol:
+    r = relations.get (rel)
+    if r is None: # deleted
         continue
-
-    # get current content from api
-    r = api.RelationGet (row[0])
-    if r['uid'] != 8199540: # only fix our own changesets
+    if r['uid'] != connect.MY_UID: # only fix our own changesets
         continue
 
     ref     = r['tag'].get ('ref')
@@ -47,9 +73,9 @@ for row in rows:
     comment = set ()
 
     if ref and name:
-        m = re.match ('^%s - (.+)$' % ref, name)
-        if m:
-            new_name = m.group (1)
+        prefix = ref + ' - '
+        if name.startswith (prefix) and len (name) > len (prefix):
+            new_name = name[len (prefix):]
             print ('Bogus name : "%s" %s' % (name, msg))
             print ('New name   : "%s" %s' % (new_name, msg))
 
@@ -57,7 +83,8 @@ for row in rows:
             comment.add ('fix route name')
             row_changed = True
 
-    if ref and re.match ('^[0-9]+[ABC]?$', ref) :
+    new_symbol = new_symbol_for (ref)
+    if new_symbol:
         if symbol != new_symbol:
             print ("Bogus symbol: %s %s" % (symbol, msg))
 
@@ -65,28 +92,15 @@ for row in rows:
             comment.add ('fix osmc:symbol')
             row_changed = True
 
-    if ref and network is None:
+    new_network = rules.default_network.get (route)
+    if ref and network is None and new_network:
         print ("No network %s" % msg)
 
-        r['tag']['network'] = 'lwn'
+        r['tag']['network'] = new_network
         comment.add ('add network')
         row_changed = True
 
-    if 0 and row_changed:
-        if cs is None:
-            cs = api.ChangesetCreate ({})
-        r = api.RelationUpdate (r)
-        changes += 1
-
-    if changes >= 10:
-        print ("%d changes" % changes)
-        api.ChangesetUpdate ({ 'comment' : ', '.join (list (comment)) })
-        api.ChangesetClose ()
-        cs = None
-        changes = 0
-
+    if args.edit and row_changed:
+        uploader.modify ('relation', r, comment)
 
-if cs is not None:
-    print ("%d changes" % changes)
-    api.ChangesetUpdate ({ 'comment' : ', '.join (list (comment)) })
-    api.ChangesetClose ()
+uploader.flush ()
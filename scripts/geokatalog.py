@@ -1,22 +1,28 @@
 #!/usr/bin/python3
 
 import collections
+import hashlib
 import itertools
 import logging
 from logging import ERROR, WARN, INFO, DEBUG
 import math
+import mmap
 import operator
 import json
+import os
 import re
 import sys
+import tempfile
 from multiprocessing import Pool
 
 import requests
 
+import numpy
 from pyproj import Transformer
 
 # import scipy.spatial.distance
 
+import shapely
 from shapely.strtree import STRtree
 import shapely.ops
 from shapely import wkt, wkb
@@ -61,11 +67,81 @@ itransformer = Transformer.from_crs ("EPSG:25832", "EPSG:4326", always_xy = True
 
 gk_routes  = dict ()
 osm_routes = dict ()
-gk_routes_by_id = dict ()  # needed for STRtree
-osm_routes_by_id = dict () # needed for STRtree
+gk_tree_routes  = [] # the routes in the order of the STRtree
+osm_tree_routes = [] # the routes in the order of the STRtree
 gk_tree = None  # STRtree
 osm_tree = None # STRtree
 
+arena_dir  = None # tempfile.TemporaryDirectory holding the arena files
+arena_file = None # the arena file of this worker process
+arena_maps = dict ()
+
+GeomRef = collections.namedtuple ('GeomRef', 'path offset length bounds')
+""" Where to find a geometry in the arena.  We keep the bounds here so that the
+parent can build the spatial indices without loading any geometry. """
+
+
+def arena_put (geom):
+    """ Write a geometry into the arena file of this worker.
+
+    Returns a reference to it.  Every worker process appends to its own file,
+    so no locking is needed.
+    """
+
+    global arena_file
+
+    if arena_file is None or arena_file[0] != os.getpid ():
+        path = os.path.join (arena_dir.name, 'arena-%d.wkb' % os.getpid ())
+        arena_file = (os.getpid (), open (path, 'ab'))
+
+    fp = arena_file[1]
+    data = geom.wkb
+    offset = fp.tell ()
+    fp.write (data)
+    fp.flush ()
+    return GeomRef (fp.name, offset, len (data), geom.bounds)
+
+
+def arena_bytes (ref):
+    """ Return the WKB of a geometry in the arena. """
+
+    if ref.path not in arena_maps:
+        with open (ref.path, 'rb') as fp:
+            arena_maps[ref.path] = mmap.mmap (fp.fileno (), 0, access = mmap.ACCESS_READ)
+
+    return arena_maps[ref.path][ref.offset:ref.offset + ref.length]
+
+
+def arena_get (ref):
+    """ Load a geometry from the arena. """
+    return wkb.loads (arena_bytes (ref))
+
+
+class Route (dict):
+    """ A route whose geometries are loaded from the arena on first access.
+
+    The workers return only :class:`GeomRef` in refs.  Geometries are loaded
+    lazily, so the parent never sees the geometries it doesn't check.
+    """
+
+    def __init__ (self, refs, *args, **kwargs):
+        super ().__init__ (*args, **kwargs)
+        self.refs = refs
+
+    def __missing__ (self, key):
+        if key not in self.refs:
+            raise KeyError (key)
+        geom = self[key] = arena_get (self.refs[key])
+        return geom
+
+    def __contains__ (self, key):
+        return super ().__contains__ (key) or key in self.refs
+
+
+def project (geom, t = transformer):
+    """ Project the geometry with one call to the transformer. """
+    return shapely.transform (geom, lambda c: numpy.column_stack (t.transform (c[:, 0], c[:, 1])))
+
 
 def buffer (geom):
     """ Buffer the route geometry. """
@@ -74,9 +150,131 @@ def buffer (geom):
 
 def clip_area (geom):
     """ Clip route geometry to the area of interest. """
+    if boundary_utm_prep.contains (geom):
+        return geom
     return boundary_utm.intersection (geom)
 
 
+Cover = collections.namedtuple ('Cover', 'union bounds')
+
+COVERS_SIZE = 256
+""" Max. no. of unions kept in :data:`covers`. """
+
+covers = collections.OrderedDict ()
+""" LRU cache of the unions of matched buffers, by frozenset of route ids. """
+
+
+def get_cover (routes):
+    """ Return the (cached) union of the buffers of the routes. """
+
+    key = frozenset ([ r['id'] for r in routes ])
+    if key in covers:
+        covers.move_to_end (key)
+        return covers[key]
+
+    union = shapely.union_all ([ r['buffered'] for r in routes ])
+    shapely.prepare (union)
+    covers[key] = Cover (union, union.bounds)
+    if len (covers) > COVERS_SIZE:
+        covers.popitem (last = False)
+    return covers[key]
+
+
+def bounds_within (inner, outer):
+    """ Return True if the bounds inner are inside the bounds outer. """
+    return (inner[0] >= outer[0] and inner[1] >= outer[1] and
+            inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def first_uncovered (geom, cover):
+    """Return the first stretch of geom that is outside the cover.
+
+    Returns None if geom is fully covered.  Else splits the first line that is
+    not covered into segments and returns the uncovered parts of the first run
+    of segments that are not fully covered, so we never compute the difference
+    of the whole geometry.
+
+    """
+
+    if bounds_within (geom.bounds, cover.bounds) and cover.union.contains (geom):
+        return None
+
+    for line in shapely.get_parts (geom):
+        if line.geom_type != 'LineString':
+            continue
+        if bounds_within (line.bounds, cover.bounds) and cover.union.contains (line):
+            continue
+
+        coords = shapely.get_coordinates (line)
+        segments = shapely.linestrings (numpy.stack ((coords[:-1], coords[1:]), axis = 1))
+        outside = numpy.flatnonzero (~shapely.contains (cover.union, segments))
+        if len (outside) == 0:
+            continue
+
+        # the first run of consecutive uncovered segments
+        start = outside[0]
+        gaps = numpy.flatnonzero (numpy.diff (outside) > 1)
+        end = outside[gaps[0]] if len (gaps) else outside[-1]
+        return shapely.union_all (shapely.difference (segments[start:end + 1], cover.union))
+
+    # only points outside, eg. where the clipped route touches the border
+    return None
+
+
+def osm_digest (rel_id):
+    """Return a digest of an OSM route.
+
+    The versions of the relation and all its members change whenever anything
+    in the route changes, so we need not look at the geometry.
+
+    """
+
+    rel = osm_routes[rel_id]
+    if 'digest' not in rel:
+        versions = connect.store.versions (rel['relation'])
+        rel['digest'] = hashlib.sha1 (json.dumps (versions).encode ('utf-8')).hexdigest ()
+    return rel['digest']
+
+
+def gk_digest (gk_id):
+    """ Return a digest of the properties and the geometry of a geokatalog route. """
+
+    gk_route = gk_routes[gk_id]
+    if 'digest' not in gk_route:
+        h = hashlib.sha1 (json.dumps (gk_route['properties'], sort_keys = True).encode ('utf-8'))
+        h.update (arena_bytes (gk_route.refs['geometry']))
+        gk_route['digest'] = h.hexdigest ()
+    return gk_route['digest']
+
+
+def osm_inputs (rel_id):
+    """Return a digest of everything the checks of an OSM route depend on.
+
+    That is the route itself and all geokatalog routes that may match it.  The
+    candidates are found on the bounding boxes only, which gives a superset of
+    the routes :func:`check_osm_covered` looks at.
+
+    """
+
+    h = hashlib.sha1 (osm_digest (rel_id).encode ('utf-8'))
+    bbox = shapely.box (*osm_routes[rel_id].refs['buffered'].bounds)
+    for gk_id in sorted ([ gk_tree_routes[i]['id'] for i in gk_tree.query (bbox) ]):
+        h.update (gk_digest (gk_id).encode ('utf-8'))
+    return h.hexdigest ()
+
+
+def gk_inputs (gk_id):
+    """ Return a digest of everything the checks of a geokatalog route depend on. """
+
+    h = hashlib.sha1 (gk_digest (gk_id).encode ('utf-8'))
+    refs = gk_routes[gk_id].refs
+    if 'clipped' in refs:
+        bbox = shapely.box (*refs['clipped'].bounds)
+        for rel_id in sorted ([ osm_tree_routes[i]['id'] for i in osm_tree.query (bbox) ]):
+            h.update (osm_digest (rel_id).encode ('utf-8'))
+    return h.hexdigest ()
+
+
 def match_route (rtags, gk_props):
     """ See if these routes match using metadata only. """
 
@@ -100,151 +298,236 @@ def match_route (rtags, gk_props):
     return False
 
 
-def get_relation (osm_relation):
-    rel_id = osm_relation['id']
-    try:
-        rfull = connect.relation_full (rel_id)
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 410:
-            # relation not found
-            return None
-        raise
+def get_relation (item):
+    """ Build the geometries of an OSM relation.
+
+    item is a tuple of relation id and the full element list, as yielded by
+    the data source.  Returns the id and the arena references of the
+    geometries.  The element list stays in the parent.
+    """
+
+    rel_id, rfull = item
+    if rfull is None:
+        # relation deleted or not found
+        return None
 
     try:
-        relation = rfull[-1]
-        rtags = relation['tags']
-        res = {
-            'id'         : rel_id,
-            'properties' : rtags,
-            'relation'   : relation,
-            'rfull'      : rfull,
-        }
+        refs = dict ()
+
+        # the store of this worker process
+        relation = connect.store.add (rfull)
 
-        geom = connect.osm_relation_as_multilinestring (rfull)
-        geom = shapely.ops.transform (transformer.transform, geom)
+        geom = connect.osm_relation_as_multilinestring (connect.store, relation, False, transformer)
 
-        res['geometry'] = geom
-        res['geometry'].id = rel_id
+        refs['geometry'] = arena_put (geom)
 
-        clipped = connect.osm_relation_as_multilinestring (rfull, True)
-        clipped = shapely.ops.transform (transformer.transform, clipped)
+        clipped = connect.osm_relation_as_multilinestring (connect.store, relation, True, transformer)
 
         clipped = clip_area (clipped)
 
         if not clipped.is_empty:
-            res['clipped']  = clipped
-            res['buffered'] = buffer (geom)
+            refs['clipped']  = arena_put (clipped)
+            refs['buffered'] = arena_put (buffer (geom))
 
     except KeyError:
         return None
 
-    return res
+    return rel_id, refs
+
+
+def project_gk_feature (item):
+    """ Project the line of a geokatalog feature.  Returns id, properties and WKB. """
+
+    gk_id, props, coords = item
+    # coords is lon,lat
+    return gk_id, props, shapely.to_wkb (project (LineString (coords)))
 
 
 def process_gk_route (gk_dict):
-    lines = gk_dict['lines']
-    geom = shapely.ops.linemerge ([ wkb.loads (l, hex = True) for l in lines ])
-    if geom.type == 'LineString':
+    """ Build the geometries of a geokatalog route.
+
+    Returns the id and the arena references of the geometries.
+    """
+
+    # sort to make the merged geometry, and so its digest, independent of the input order
+    lines = sorted (gk_dict['lines'])
+    geom = shapely.line_merge (shapely.multilinestrings (shapely.from_wkb (lines)))
+    if geom.geom_type == 'LineString':
         geom = MultiLineString ([geom])
-    geom = shapely.ops.transform (transformer.transform, geom)
 
     # geom = resample (geom, RESAMPLE)
-    gk_dict['geometry'] = geom
+    refs = dict ()
+    refs['geometry'] = arena_put (geom)
 
     clipped = clip_area (geom)
     if not clipped.is_empty:
-        gk_dict['clipped']  = clipped
-        gk_dict['buffered'] = buffer (geom)
+        refs['clipped']  = arena_put (clipped)
+        refs['buffered'] = arena_put (buffer (geom))
+
+    return gk_dict['id'], refs
 
-    return gk_dict
+
+def keep_relations (items):
+    """ Add the elements to the store on their way to the workers. """
+
+    for rel_id, rfull in items:
+        if rfull is not None:
+            connect.store.add (rfull)
+        yield rel_id, rfull
 
 
 def init (osm_relations, filenames):
     """ Build a spatial index tree of the features. """
 
-    global gk_tree, osm_tree
+    global gk_tree, osm_tree, arena_dir
 
     geokatalog.log = logging.getLogger ().log
 
     log (INFO, "preparing areas")
 
-    geokatalog.boundary_utm = shapely.ops.transform (transformer.transform, connect.boundary)
+    geokatalog.boundary_utm = project (connect.boundary)
     geokatalog.boundary_utm_prep = prep (boundary_utm)
 
-    log (INFO, "getting OSM routes from OSM API")
+    log (INFO, "getting OSM routes and reading GK routes")
+
+    # The OSM relations stream from the source straight into the workers, and
+    # so do the features of the geokatalog files.  A geokatalog route may be
+    # split into many features, so the routes are built once all features are
+    # in.  The trees are built when both are done.
+    #
+    # We need two pools because a pool feeds its tasks strictly in order.  They
+    # share the cpus.
+    #
+    # The workers write the geometries as WKB into arena files and return only
+    # references, which are cheap to pickle.  The elements are added to the
+    # store here on their way to the workers.
+
+    arena_dir = tempfile.TemporaryDirectory (prefix = 'geokatalog-')
+
+    cpus = os.cpu_count () or 1
+    osm_processes = max (1, cpus // 2)
+    gk_processes  = max (1, cpus - osm_processes)
+
+    with Pool (osm_processes) as osm_pool, Pool (gk_processes) as gk_pool:
+        osm_results = osm_pool.imap_unordered (get_relation, keep_relations (
+            connect.source.iter_relations_full (
+                [ r['id'] for r in osm_relations ],
+                dict ([ (r['id'], r.get ('version')) for r in osm_relations ])
+            )
+        ))
+
+        geoms_by_id = merge_gk_features (tqdm (
+            gk_pool.imap_unordered (project_gk_feature, read_geokatalog (filenames), chunksize = 64),
+            desc = 'GK Features'
+        ))
+        gk_results = gk_pool.imap_unordered (process_gk_route, geoms_by_id.values ())
+
+        osm_geoms = list (tqdm (osm_results, total = len (osm_relations), desc = 'OSM Routes'))
+        gk_geoms  = list (tqdm (gk_results,  total = len (geoms_by_id),   desc = 'GK Routes'))
+
+    # The trees are built on the bounding boxes, which is all the STRtree looks
+    # at anyway.  The geometries are loaded when a check needs them.  A query
+    # returns indices into the *_tree_routes lists.
+
+    # sort to make the trees independent of the order of arrival
+    osm_geoms = sorted ([ g for g in osm_geoms if g is not None and 'buffered' in g[1] ], key = operator.itemgetter (0))
+    for rel_id, refs in osm_geoms:
+        relation = connect.store.relations[rel_id]
+        osm_routes[rel_id] = Route (refs, {
+            'id'         : rel_id,
+            'properties' : relation.tags,
+            'relation'   : relation,
+        })
+        osm_tree_routes.append (osm_routes[rel_id])
 
-    with Pool () as p:
-        geoms = list (tqdm (p.imap (get_relation, osm_relations),
-                            total = len (osm_relations),
-                            desc = 'OSM Routes'))
+    osm_tree = STRtree (shapely.box (*numpy.array (
+        [ refs['buffered'].bounds for rel_id, refs in osm_geoms ]
+    ).reshape (-1, 4).T))
 
-    geoms = [ g for g in geoms if g is not None and 'buffered' in g]
-    for g in geoms:
-        osm_routes[g['id']] = g
-        osm_routes_by_id[id (g['buffered'])] = g
+    log (INFO, "  %d relations found in osm" % len (osm_geoms))
 
-    osm_tree = STRtree ([ g['buffered'] for g in geoms ])
+    gk_geoms = sorted (gk_geoms, key = operator.itemgetter (0))
+    for gk_id, refs in gk_geoms:
+        gk_routes[gk_id] = Route (refs, geoms_by_id[gk_id])
+        del gk_routes[gk_id]['lines']
+        gk_tree_routes.append (gk_routes[gk_id])
 
-    log (INFO, "  %d relations found in osm" % len (geoms))
+    gk_tree = STRtree (shapely.box (*numpy.array (
+        [ refs['geometry'].bounds for gk_id, refs in gk_geoms ]
+    ).reshape (-1, 4).T))
 
-    # get geokatalog routes from geojson files
+    log (INFO, "  %d relations found in geokatalog" % len (gk_geoms))
 
-    geoms_by_id = dict ()
 
-    for filename in set (filenames):
-        with open (filename, 'r') as fp:
-            log (INFO, "reading %s" % filename)
+def read_features (filename):
+    """Yield the features in a GeoJSON file one at a time.
 
-            data = json.load (fp)
+    ogr2ogr writes one feature per line, so we can parse those files
+    incrementally.  Other files are read whole.
 
-            for feature in data['features']:
-                props = feature['properties']
+    """
+
+    found = False
+    with open (filename, 'r') as fp:
+        for line in fp:
+            if line.startswith ('{ "type": "Feature"'):
+                found = True
+                yield json.loads (line.rstrip ().rstrip (','))
+
+        if not found:
+            fp.seek (0)
+            yield from json.load (fp)['features']
+
+
+def read_geokatalog (filenames):
+    """Yield the features of the geokatalog routes in geojson files.
+
+    Yields tuples of id, properties and coordinates.
 
-                # '.' is placeholder in geoportal data
-                gk_ref  = str (props.get ('WEGENR', '.'))
-                gk_name = str (props.get ('ROUTENNAME', '.'))
-                gk_id   = str (props.get ('ID'))
-                if gk_ref == '.' and gk_name == '.':
-                    continue
+    """
+
+    for filename in set (filenames):
+        log (INFO, "reading %s" % filename)
 
-                # fix data errors
-                if re.match (r'Dolomiten.*öhenweg', gk_name):
-                    if gk_ref != '.':
-                        props['WEGENR'] = 'AV' + gk_ref
-                    else:
-                        m = re.search (r'(\d)$', gk_name)
-                        if m:
-                            props['WEGENR'] = 'AV' + m.group (1)
+        for feature in read_features (filename):
+            props = feature['properties']
 
-                coords = feature['geometry']['coordinates']
-                # coords is lon,lat
-                line = LineString (coords)
+            # '.' is placeholder in geoportal data
+            gk_ref  = str (props.get ('WEGENR', '.'))
+            gk_name = str (props.get ('ROUTENNAME', '.'))
+            gk_id   = str (props.get ('ID'))
+            if gk_ref == '.' and gk_name == '.':
+                continue
 
-                if gk_id not in geoms_by_id:
-                    geoms_by_id[gk_id] = {
-                        'id'         : gk_id,
-                        'properties' : props,
-                        'lines'      : set (),
-                    }
+            # fix data errors
+            if re.match (r'Dolomiten.*öhenweg', gk_name):
+                if gk_ref != '.':
+                    props['WEGENR'] = 'AV' + gk_ref
+                else:
+                    m = re.search (r'(\d)$', gk_name)
+                    if m:
+                        props['WEGENR'] = 'AV' + m.group (1)
 
-                # this eliminates duplicate geometries, wkb makes it hashable
-                geoms_by_id[gk_id]['lines'].add (line.wkb_hex)
+            yield gk_id, props, feature['geometry']['coordinates']
 
-    log (INFO, "processing GK routes")
 
-    with Pool () as p:
-        geoms = list (tqdm (p.imap (process_gk_route, geoms_by_id.values ()),
-                            total = len (geoms_by_id),
-                            desc = 'GK Routes'))
-    for g in geoms:
-        gk_id = g['id']
-        g['geometry'].id = gk_id
-        gk_routes[gk_id] = g
+def merge_gk_features (features):
+    """ Collect the projected lines of the features by route id. """
 
-    gk_tree = STRtree ([ g['geometry'] for g in geoms ])
+    geoms_by_id = dict ()
+
+    for gk_id, props, line in features:
+        if gk_id not in geoms_by_id:
+            geoms_by_id[gk_id] = {
+                'id'         : gk_id,
+                'properties' : props,
+                'lines'      : set (),
+            }
 
-    log (INFO, "  %d relations found in geokatalog" % len (geoms))
+        # this eliminates duplicate geometries, wkb makes it hashable
+        geoms_by_id[gk_id]['lines'].add (line)
 
+    return geoms_by_id
 
 
 def check_osm_covered (rel_id, errors):
@@ -261,35 +544,32 @@ def check_osm_covered (rel_id, errors):
 
     osm_mls    = rel['clipped']
     osm_buffer = rel['buffered']
+    osm_buffer_prep = prep (osm_buffer)
 
     # search geokatalog for one or more routes that may be used to cover it
     matches = []
 
     # try matching on metadata
     # we need this because an OSM route can be matched by more than one GK routes
-    for gk_mls in gk_tree.query (osm_buffer):
-        # sometimes two very short routes run in parallel, so we need a bit of
-        # buffer to make them intersect
-        if gk_mls.intersects (osm_buffer):
-            gk_id = gk_mls.id
-            gk_route = gk_routes[gk_id]
-            if 'buffered' in gk_route:
-                m = match_route (rtags, gk_route['properties'])
-                if m:
-                    matches.append (gk_route)
+    for i in gk_tree.query (osm_buffer):
+        gk_route = gk_tree_routes[i]
+        if 'buffered' in gk_route and match_route (rtags, gk_route['properties']):
+            # sometimes two very short routes run in parallel, so we need a bit
+            # of buffer to make them intersect
+            if osm_buffer_prep.intersects (gk_route['geometry']):
+                matches.append (gk_route)
 
     if not matches:
         errors.append ((ERROR, 'Route not found in geokatalog.'))
         return
 
-    match = shapely.ops.unary_union (list (m['buffered'] for m in matches))
+    d = first_uncovered (osm_mls, get_cover (matches))
 
-    if not match.contains (osm_mls):
-        d = osm_mls.difference (match)
+    if d is not None:
         errors.append ((ERROR, 'OSM route outside GK buffer for {length:.0f}m. Matched {matches}'.format (
             length = d.length,
             matches = '; '.join ([ connect.format_gk_route (m['properties']) for m in matches]))))
-        d = shapely.ops.transform (itransformer.transform, d)
+        d = project (d, itransformer)
         errors.append ((ERROR, 'http://localhost:8111/load_and_zoom?left={0:.6f}&right={2:.6f}&top={3:.6f}&bottom={1:.6f}'.format (*d.bounds)))
 
     elif errors:
@@ -311,27 +591,28 @@ def check_geokatalog_covered (gk_id, errors):
     gk_props   = gk_route['properties']
     gk_clipped = gk_route['clipped']
 
+    gk_clipped_prep = prep (gk_clipped)
+
     matches = []
 
     # search osm for routes that intersect and match on metadata
-    for osm_buffer in osm_tree.query (gk_clipped):
-        rel = osm_routes_by_id[id (osm_buffer)]
-        if osm_buffer.intersects (gk_clipped):
-            if match_route (rel['properties'], gk_props):
+    for i in osm_tree.query (gk_clipped):
+        rel = osm_tree_routes[i]
+        if match_route (rel['properties'], gk_props):
+            if gk_clipped_prep.intersects (rel['buffered']):
                 matches.append (rel)
 
     if not matches:
         errors.append ((ERROR, 'No intersecting osm route matches with ref or name.'))
-        c = shapely.ops.transform (itransformer.transform, gk_clipped)
+        c = project (gk_clipped, itransformer)
         errors.append ((ERROR, 'http://localhost:8111/zoom?left={0:.6f}&right={2:.6f}&top={3:.6f}&bottom={1:.6f}'.format (*c.bounds)))
         return
 
-    osm_buffer = shapely.ops.unary_union (list (m['buffered'] for m in matches))
+    d = first_uncovered (gk_clipped, get_cover (matches))
 
-    if not osm_buffer.contains (gk_clipped):
-        d = gk_clipped.difference (osm_buffer)
+    if d is not None:
         errors.append ((ERROR, 'GK route outside OSM buffer for {length:.0f}m. Matched {matches}'.format (
             length = d.length,
             matches = '; '.join ([ connect.format_route (m['relation']) for m in matches]))))
-        d = shapely.ops.transform (itransformer.transform, d)
+        d = project (d, itransformer)
         errors.append ((ERROR, 'http://localhost:8111/load_and_zoom?left={0:.6f}&right={2:.6f}&top={3:.6f}&bottom={1:.6f}'.format (*d.bounds)))
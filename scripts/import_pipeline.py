@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+
+"""Run the import stages of the Makefile as a DAG.
+
+Every stage is a make target.  A stage starts as soon as all the stages it
+depends on are done, so independent stages run concurrently, eg. the osm2pgsql
+and the snapshot loads, and the DTM processing.  Stages whose target is up to
+date are skipped, so after a failure a rerun resumes at the failed stage.
+
+The start, duration, exit status and resource usage of every stage are kept in
+a JSON state file.  The resource usage is that of the make process and its
+children, it does not include the work done inside the PostgreSQL server.
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import time
+
+Stage = collections.namedtuple ('Stage', 'name target deps')
+
+STAGES = (
+    Stage ('clip',           'osm-clipped',                ()),
+    Stage ('osm2pgsql',      'touch/osm2pgsql',            ('clip', )),
+    Stage ('snapshot',       'touch/osmosis',              ('clip', )),
+    Stage ('hikemap-sql',    'touch/hikemap.sql',          ('osm2pgsql', 'snapshot')),
+    Stage ('check-parallel', 'check-parallel',             ('hikemap-sql', )),
+    Stage ('dtm-warp',       'data/dtm-warped.tif',        ()),
+    Stage ('hill-shade',     'data/hill-shade.tif',        ('dtm-warp', )),
+    Stage ('contours-25',    'data/contour-lines-25.shp',  ('dtm-warp', )),
+    Stage ('contours-100',   'data/contour-lines-100.shp', ('dtm-warp', )),
+    Stage ('import-dem',     'touch/import_dem',           ('dtm-warp', )),
+)
+""" The stages: name, make target, names of the stages it depends on. """
+
+STAGES_BY_NAME = dict ([ (s.name, s) for s in STAGES ])
+
+MAKE = os.environ.get ('MAKE', 'make')
+
+
+def make_env ():
+    """ The environment for make.  We do the scheduling, so drop the parent make's flags. """
+
+    env = dict (os.environ)
+    env.pop ('MAKEFLAGS', None)
+    env.pop ('MFLAGS', None)
+    return env
+
+
+def with_deps (names):
+    """ Return the stages in names and all stages they depend on, in STAGES order. """
+
+    todo = set ()
+    stack = list (names)
+    while stack:
+        name = stack.pop ()
+        if name not in todo:
+            todo.add (name)
+            stack.extend (STAGES_BY_NAME[name].deps)
+    return [ s for s in STAGES if s.name in todo ]
+
+
+class State ():
+    """ The state file. """
+
+    def __init__ (self, filename):
+        self.filename = filename
+        self.data = { 'stages' : {} }
+        if os.path.exists (filename):
+            with open (filename, 'r') as fp:
+                self.data = json.load (fp)
+
+    def update (self, name, **kwargs):
+        self.data['stages'].setdefault (name, {}).update (kwargs)
+        self.save ()
+
+    def save (self):
+        os.makedirs (os.path.dirname (self.filename) or '.', exist_ok = True)
+        tmp = self.filename + '.tmp'
+        with open (tmp, 'w') as fp:
+            json.dump (self.data, fp, indent = 2, sort_keys = True)
+        os.replace (tmp, self.filename)
+
+    def print (self):
+        print ("{:16} {:10} {:>9} {:>9} {:>9} {:>9}".format (
+            'stage', 'status', 'elapsed', 'user', 'sys', 'max rss'))
+        for stage in STAGES:
+            s = self.data['stages'].get (stage.name, {})
+            print ("{:16} {:10} {:>8.0f}s {:>8.0f}s {:>8.0f}s {:>7.0f}MB".format (
+                stage.name, s.get ('status', '-'), s.get ('elapsed', 0), s.get ('utime', 0),
+                s.get ('stime', 0), s.get ('maxrss', 0) / 1024))
+
+
+def up_to_date (stage):
+    """ Ask make if the target of the stage is up to date. """
+
+    return subprocess.run ([MAKE, '-q', stage.target], env = make_env (),
+                           stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL).returncode == 0
+
+
+def run_stage (stage, logdir):
+    """ Run make on the target of the stage.  Returns a dict with exit status and resource usage. """
+
+    start = time.time ()
+    with open (os.path.join (logdir, stage.name + '.log'), 'w') as log:
+        proc = subprocess.Popen ([MAKE, '--no-print-directory', stage.target], env = make_env (),
+                                 stdin = subprocess.DEVNULL, stdout = log, stderr = subprocess.STDOUT)
+        _, status, rusage = os.wait4 (proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode (status)
+
+    return {
+        'status'     : 'done' if proc.returncode == 0 else 'failed',
+        'returncode' : proc.returncode,
+        'elapsed'    : time.time () - start,
+        'utime'      : rusage.ru_utime,
+        'stime'      : rusage.ru_stime,
+        'maxrss'     : rusage.ru_maxrss, # in KB
+    }
+
+
+def run (stages, state, logdir, jobs):
+    """Run the stages, each as soon as its dependencies are done.
+
+    Returns the names of the failed stages.
+
+    """
+
+    names   = set ([ s.name for s in stages ])
+    todo    = list (stages)
+    done    = set ()
+    failed  = set ()
+    blocked = set ()
+    running = dict ()
+
+    def ready (stage):
+        return all ([ d in done for d in stage.deps if d in names ])
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as executor:
+        while todo or running:
+            for stage in list (todo):
+                if any ([ d in failed or d in blocked for d in stage.deps ]):
+                    todo.remove (stage)
+                    blocked.add (stage.name)
+                    state.update (stage.name, status = 'blocked')
+                    print ("%-16s blocked" % stage.name)
+                elif ready (stage):
+                    todo.remove (stage)
+                    if up_to_date (stage):
+                        print ("%-16s up to date" % stage.name)
+                        state.update (stage.name, status = 'up-to-date')
+                        done.add (stage.name)
+                        continue
+                    print ("%-16s started" % stage.name)
+                    state.update (stage.name, status = 'running', started = time.time ())
+                    running[executor.submit (run_stage, stage, logdir)] = stage
+
+            if not running:
+                continue
+
+            finished, _ = concurrent.futures.wait (running, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop (future)
+                result = future.result ()
+                state.update (stage.name, **result)
+                print ("%-16s %s in %.0fs" % (stage.name, result['status'], result['elapsed']))
+                if result['status'] == 'done':
+                    done.add (stage.name)
+                else:
+                    failed.add (stage.name)
+
+    return failed
+
+
+def build_parser ():
+    """ Build the commandline parser. """
+
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument (
+        'stages', nargs='*', metavar='STAGE',
+        help='run these stages and the stages they depend on (%s) (default: all)' % ', '.join (
+            [ s.name for s in STAGES ]),
+    )
+    parser.add_argument (
+        '-j', '--jobs', type=int, metavar='N', default=4,
+        help='run at most N stages at once (default=4)',
+    )
+    parser.add_argument (
+        '--state', metavar='FILENAME', default='data/import-state.json',
+        help='the state file (default=data/import-state.json)',
+    )
+    parser.add_argument (
+        '--logdir', metavar='DIR', default='data/import-logs',
+        help='write the output of every stage into DIR/STAGE.log (default=data/import-logs)',
+    )
+    parser.add_argument (
+        '--status', action='store_true',
+        help='print the state of the last run and exit',
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser ().parse_args ()
+
+    for name in args.stages:
+        if name not in STAGES_BY_NAME:
+            sys.exit ('unknown stage: %s' % name)
+
+    state = State (args.state)
+    if args.status:
+        state.print ()
+        sys.exit ()
+
+    os.makedirs (args.logdir, exist_ok = True)
+    state.data['started'] = time.time ()
+
+    start = time.time ()
+    failed = run (with_deps (args.stages or STAGES_BY_NAME), state, args.logdir, args.jobs)
+    print ("total %.0fs" % (time.time () - start))
+
+    if failed:
+        print ('Failed stages: %s (see %s)' % (' '.join (sorted (failed)), args.logdir))
+        sys.exit (1)
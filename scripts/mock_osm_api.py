@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+"""A mock OSM API server for testing the editing scripts.
+
+Serves the elements in an OSM XML file and accepts changesets with osmChange
+diff uploads, keeping everything in memory.  Implements only the calls our
+scripts use.  Point the scripts at it with eg. ``--api http://localhost:8111``.
+
+"""
+
+import argparse
+import itertools
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import xml.etree.ElementTree as ET
+
+KINDS = ('node', 'way', 'relation')
+
+
+class MockApi ():
+    """ The state of the mock server. """
+
+    def __init__ (self, uid, user, lose_responses = 0):
+        self.elements       = dict ()
+        self.changesets     = dict ()
+        self.next_cs        = itertools.count (1)
+        self.uid            = uid
+        self.user           = user
+        self.lose_responses = lose_responses
+        self.lock           = threading.Lock ()
+
+    def load (self, filename):
+        for e in ET.parse (filename).getroot ():
+            if e.tag in KINDS:
+                self.elements[(e.tag, int (e.get ('id')))] = e
+
+    def timestamp (self):
+        return time.strftime ('%Y-%m-%dT%H:%M:%SZ', time.gmtime ())
+
+    def create_changeset (self, body):
+        with self.lock:
+            cs = next (self.next_cs)
+            tags = [ t for t in ET.fromstring (body).iter ('tag') ] if body else []
+            self.changesets[cs] = { 'open' : True, 'changes' : [], 'created_at' : self.timestamp (), 'tags' : tags }
+            return cs
+
+    def upload (self, cs, body):
+        """Apply an osmChange diff.  Returns the diffResult or raises ValueError.
+
+        Like the real API the upload is all or nothing.
+
+        """
+
+        with self.lock:
+            changeset = self.changesets.get (cs)
+            if changeset is None:
+                raise LookupError ()
+            if not changeset['open']:
+                raise ValueError ('The changeset %d was closed' % cs)
+
+            actions = []
+            for action in ET.fromstring (body):
+                if action.tag != 'modify':
+                    raise ValueError ('Action %s not supported by the mock server' % action.tag)
+                for e in action:
+                    key = (e.tag, int (e.get ('id')))
+                    old = self.elements.get (key)
+                    if old is None:
+                        raise ValueError ('The %s %d does not exist' % key)
+                    if e.get ('version') != old.get ('version'):
+                        raise ValueError ('Version mismatch: Provided %s, server had: %s of %s %d' % (
+                            e.get ('version'), old.get ('version'), key[0], key[1]))
+                    actions.append ((key, e))
+
+            result = ET.Element ('diffResult', version = '0.6', generator = 'mock_osm_api')
+            for key, e in actions:
+                version = str (int (e.get ('version')) + 1)
+                e.set ('version', version)
+                e.set ('changeset', str (cs))
+                e.set ('uid', str (self.uid))
+                e.set ('user', self.user)
+                e.set ('visible', 'true')
+                e.set ('timestamp', self.timestamp ())
+                self.elements[key] = e
+                changeset['changes'].append (('modify', e))
+                ET.SubElement (result, key[0], old_id = str (key[1]), new_id = str (key[1]), new_version = version)
+
+            if self.lose_responses > 0:
+                # simulate a lost response: the diff is applied but the client doesn't know
+                self.lose_responses -= 1
+                raise ConnectionAbortedError ()
+
+            return result
+
+    def close_changeset (self, cs):
+        with self.lock:
+            changeset = self.changesets.get (cs)
+            if changeset is None:
+                raise LookupError ()
+            if not changeset['open']:
+                raise ValueError ('The changeset %d was closed' % cs)
+            changeset['open'] = False
+
+    def changeset_xml (self, cs):
+        changeset = self.changesets[cs]
+        root = ET.Element ('osm', version = '0.6')
+        e = ET.SubElement (root, 'changeset',
+                           id = str (cs),
+                           open = 'true' if changeset['open'] else 'false',
+                           created_at = changeset['created_at'],
+                           uid = str (self.uid),
+                           user = self.user,
+                           changes_count = str (len (changeset['changes'])))
+        e.extend (changeset['tags'])
+        return root
+
+    def download (self, cs):
+        changeset = self.changesets[cs]
+        root = ET.Element ('osmChange', version = '0.6', generator = 'mock_osm_api')
+        for action, e in changeset['changes']:
+            ET.SubElement (root, action).append (e)
+        return root
+
+    def parents (self, kind, id_):
+        """ The relations that have the element as member. """
+
+        root = ET.Element ('osm', version = '0.6', generator = 'mock_osm_api')
+        for (k, _), e in sorted (self.elements.items ()):
+            if k == 'relation' and any ([ m.get ('type') == kind and int (m.get ('ref')) == id_
+                                          for m in e.iter ('member') ]):
+                root.append (e)
+        return root
+
+    def get (self, kind, ids):
+        root = ET.Element ('osm', version = '0.6', generator = 'mock_osm_api')
+        for id_ in ids:
+            e = self.elements.get ((kind, id_))
+            if e is None:
+                raise LookupError ()
+            root.append (e)
+        return root
+
+
+class Handler (BaseHTTPRequestHandler):
+    """ Dispatch the API calls to the mock. """
+
+    mock = None
+
+    def reply (self, status, body = b'', content_type = 'text/xml; charset=utf-8'):
+        if isinstance (body, ET.Element):
+            body = ET.tostring (body, encoding = 'utf-8')
+        elif isinstance (body, str):
+            body = body.encode ('utf-8')
+        self.send_response (status)
+        self.send_header ('Content-Type', content_type)
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def body (self):
+        return self.rfile.read (int (self.headers.get ('Content-Length', 0)))
+
+    def dispatch (self, method):
+        url = urlparse (self.path)
+        path = url.path.rstrip ('/')
+        mock = self.mock
+
+        try:
+            if method == 'GET':
+                m = re.match (r'^/api/0\.6/(node|way|relation)/(\d+)$', path)
+                if m:
+                    return self.reply (200, mock.get (m.group (1), [ int (m.group (2)) ]))
+                m = re.match (r'^/api/0\.6/(node|way|relation)/(\d+)/relations$', path)
+                if m:
+                    return self.reply (200, mock.parents (m.group (1), int (m.group (2))))
+                m = re.match (r'^/api/0\.6/(nodes|ways|relations)$', path)
+                if m:
+                    kinds = m.group (1)
+                    ids = parse_qs (url.query).get (kinds, [''])[0]
+                    return self.reply (200, mock.get (kinds[:-1], [ int (i) for i in ids.split (',') if i ]))
+                m = re.match (r'^/api/0\.6/changeset/(\d+)$', path)
+                if m:
+                    return self.reply (200, mock.changeset_xml (int (m.group (1))))
+                m = re.match (r'^/api/0\.6/changeset/(\d+)/download$', path)
+                if m:
+                    return self.reply (200, mock.download (int (m.group (1))))
+
+            if method == 'PUT':
+                if path == '/api/0.6/changeset/create':
+                    return self.reply (200, str (mock.create_changeset (self.body ())), 'text/plain')
+                m = re.match (r'^/api/0\.6/changeset/(\d+)/close$', path)
+                if m:
+                    mock.close_changeset (int (m.group (1)))
+                    return self.reply (200)
+
+            if method == 'POST':
+                m = re.match (r'^/api/0\.6/changeset/(\d+)/upload$', path)
+                if m:
+                    return self.reply (200, mock.upload (int (m.group (1)), self.body ()))
+
+            return self.reply (404, 'Not found', 'text/plain')
+
+        except LookupError:
+            return self.reply (404, 'Not found', 'text/plain')
+        except ValueError as e:
+            return self.reply (409, str (e), 'text/plain')
+        except ConnectionAbortedError:
+            self.close_connection = True
+
+    def do_GET (self):
+        self.dispatch ('GET')
+
+    def do_PUT (self):
+        self.dispatch ('PUT')
+
+    def do_POST (self):
+        self.dispatch ('POST')
+
+
+def build_parser ():
+    """ Build the commandline parser. """
+
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument (
+        'data', nargs='*', metavar='FILENAME.osm',
+        help='serve the elements in these OSM XML files',
+    )
+    parser.add_argument (
+        '--host', default='localhost',
+        help='listen on this address (default=localhost)',
+    )
+    parser.add_argument (
+        '--port', type=int, default=8111,
+        help='listen on this port (default=8111)',
+    )
+    parser.add_argument (
+        '--uid', type=int, default=8199540,
+        help='the uid of the editing user (default=8199540)',
+    )
+    parser.add_argument (
+        '--user', default='mock',
+        help='the name of the editing user (default=mock)',
+    )
+    parser.add_argument (
+        '--lose-responses', dest='lose_responses', type=int, metavar='N', default=0,
+        help='apply the first N uploads but drop the connection instead of answering',
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser ().parse_args ()
+
+    Handler.mock = MockApi (args.uid, args.user, args.lose_responses)
+    for filename in args.data:
+        Handler.mock.load (filename)
+
+    server = ThreadingHTTPServer ((args.host, args.port), Handler)
+    print ("Serving %d elements on http://%s:%d" % (len (Handler.mock.elements), args.host, args.port))
+    server.serve_forever ()
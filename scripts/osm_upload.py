@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""Upload edits to the OSM API in changesets.
+
+Collects the edited elements and uploads each changeset as one osmChange diff,
+instead of one API call per element.  Every changeset is written to a journal
+before and after the upload.  If a run gets interrupted, the next run finds out
+from the journal and the API which edits made it, and skips them.
+
+"""
+
+import collections
+import json
+import logging
+from logging import ERROR, WARN, INFO, DEBUG
+import os
+
+import osmapi
+
+
+def log (level, msg):
+    logging.getLogger ().log (level, msg)
+
+
+def element_key (kind, id_):
+    return '%s/%d' % (kind, id_)
+
+
+class Uploader ():
+    """Collect edits and upload them in changesets of batch_size elements.
+
+    Use like::
+
+        with Uploader (api, 'data/my-script.journal') as uploader:
+            ...
+            uploader.modify ('way', way, ['fix name'])
+
+    Elements are in osmapi format, as returned from eg. :func:`connect.get_ways`.
+
+    """
+
+    def __init__ (self, api, journal, batch_size = 10, tags = None):
+        self.api        = api
+        self.journal    = journal
+        self.batch_size = batch_size
+        self.tags       = dict (tags or {})
+        self.changes    = []
+        self.comment    = set ()
+        self.uploaded   = dict ()
+        """ The elements uploaded by this and earlier runs, key to new version. """
+        self.changesets = []
+
+        self.resume ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush ()
+
+    def write (self, record):
+        """ Append a record to the journal. """
+
+        os.makedirs (os.path.dirname (self.journal) or '.', exist_ok = True)
+        with open (self.journal, 'a') as fp:
+            fp.write (json.dumps (record) + '\n')
+            fp.flush ()
+            os.fsync (fp.fileno ())
+
+    def resume (self):
+        """Read the journal of earlier runs.
+
+        A changeset that was pending when the run got interrupted may or may not
+        have been uploaded.  Ask the API.
+
+        """
+
+        if not os.path.exists (self.journal):
+            return
+
+        pending = dict ()
+        with open (self.journal, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads (line)
+                except ValueError:
+                    break # torn last line
+                cs = record['changeset']
+                if record['event'] == 'pending':
+                    pending[cs] = record
+                else:
+                    pending.pop (cs, None)
+                    self.uploaded.update (record.get ('versions', {}))
+
+        for cs in pending:
+            self.recover (cs)
+
+    def recover (self, cs):
+        """ Find out if the diff upload to changeset cs went through. """
+
+        try:
+            diff = self.api.ChangesetDownload (cs)
+        except osmapi.ElementNotFoundApiError:
+            diff = []
+
+        versions = dict ([ (element_key (c['type'], c['data']['id']), c['data']['version'])
+                           for c in diff if c['action'] != 'delete' ])
+
+        if versions:
+            log (WARN, 'changeset %d of an interrupted run was uploaded' % cs)
+            self.write ({ 'event' : 'done', 'changeset' : cs, 'versions' : versions })
+            self.uploaded.update (versions)
+        else:
+            log (WARN, 'changeset %d of an interrupted run is empty' % cs)
+            self.write ({ 'event' : 'abandoned', 'changeset' : cs })
+
+    def modify (self, kind, element, comment = ()):
+        """Add a modified element to the current changeset.
+
+        Returns False if the element is older than a version we uploaded
+        already.  In that case the edit was made from stale data and is dropped.
+
+        """
+
+        key = element_key (kind, element['id'])
+        if element['version'] < self.uploaded.get (key, 0):
+            log (INFO, 'skipping %s: already uploaded' % key)
+            return False
+
+        self.changes.append ((kind, element))
+        self.comment.update (comment)
+        if len (self.changes) >= self.batch_size:
+            self.flush ()
+        return True
+
+    def flush (self):
+        """ Upload the current changeset. """
+
+        if not self.changes:
+            return
+
+        tags = dict (self.tags)
+        if self.comment:
+            tags['comment'] = ', '.join (sorted (self.comment))
+
+        # a modify always bumps the version by one
+        versions = dict ([ (element_key (kind, e['id']), e['version'] + 1) for kind, e in self.changes ])
+
+        # one osmChange <modify> block per element type
+        upload = collections.OrderedDict ()
+        for kind, e in self.changes:
+            upload.setdefault (kind, []).append (e)
+
+        cs = self.api.ChangesetCreate (tags)
+        self.write ({
+            'event'     : 'pending',
+            'changeset' : cs,
+            'elements'  : [ [ kind, e['id'], e['version'] ] for kind, e in self.changes ],
+        })
+        try:
+            self.api.ChangesetUpload ([ { 'type' : kind, 'action' : 'modify', 'data' : elements }
+                                        for kind, elements in upload.items () ])
+        finally:
+            self.api.ChangesetClose ()
+
+        self.write ({ 'event' : 'done', 'changeset' : cs, 'versions' : versions })
+        self.uploaded.update (versions)
+        self.changesets.append (cs)
+
+        print ("changeset %d (%d changes)" % (cs, len (self.changes)))
+        self.changes = []
+        self.comment = set ()
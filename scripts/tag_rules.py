@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+"""The tag conventions for route relations.
+
+The rules live in :file:`tag_rules.yml`.  They are compiled once into regular
+expressions indexed by route type.  The symbol rules are compiled into one
+alternation, so finding the rule for a ref takes a single regex match.
+
+"""
+
+import functools
+import hashlib
+import os.path
+import re
+
+import yaml
+
+DEFAULT_FILE = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'tag_rules.yml')
+
+
+class TagRules ():
+    """ The compiled tag rules.  digest identifies the rules file they came from. """
+
+    def __init__ (self, config, digest = None):
+        self.digest = digest
+        self.symbol_rules = config.get ('symbols', [])
+
+        # one named group per rule, the first matching rule wins
+        self.symbol_re = re.compile ('|'.join ([
+            '(?P<r%d>%s)' % (i, rule['ref']) for i, rule in enumerate (self.symbol_rules)
+        ]))
+        self.symbol_group = [
+            self.symbol_re.groupindex['r%d' % i] + 1 if re.compile (rule['ref']).groups else None
+            for i, rule in enumerate (self.symbol_rules)
+        ]
+        self.symbol_cache = dict ()
+
+        self.bogus_symbol = re.compile (config['bogus_symbol'])
+
+        self.network = dict ()
+        self.default_network = dict ()
+        for rule in config.get ('network', []):
+            for route in rule['routes']:
+                self.network[route] = re.compile (rule['network'])
+                if 'default' in rule:
+                    self.default_network[route] = rule['default']
+
+        self.bogus_name = dict ()
+        for rule in config.get ('bogus_name', []):
+            for route in rule['routes']:
+                self.bogus_name[route] = re.compile (rule['name'])
+
+        self.ref_in_name = re.compile (config['ref_in_name'])
+        self.bad_names   = re.compile (config['bad_names'])
+
+    def symbol_rule (self, ref):
+        """ Return the rule for ref and the first group of the match, or None, None. """
+
+        m = self.symbol_re.fullmatch (ref)
+        if m is None:
+            return None, None
+        i = int (m.lastgroup[1:])
+        group = self.symbol_group[i]
+        return self.symbol_rules[i], m.group (group) if group else None
+
+    def symbol_pattern (self, ref):
+        """ Return the compiled pattern the osmc:symbol of a route with ref must match.
+
+        Returns None if the symbol is not checked.
+        """
+
+        if ref not in self.symbol_cache:
+            rule, group = self.symbol_rule (ref)
+            if rule is None:
+                rx = ':%s:' % re.escape (ref)
+            else:
+                rx = rule.get ('symbol')
+                if rx and group is not None:
+                    rx = rx.replace ('{1}', re.escape (group))
+            self.symbol_cache[ref] = re.compile (rx) if rx else None
+        return self.symbol_cache[ref]
+
+    def symbol_template (self, ref):
+        """ Return the osmc:symbol a route with ref should get, or None. """
+
+        rule, group = self.symbol_rule (ref)
+        if rule is None or 'template' not in rule:
+            return None
+        return rule['template'].replace ('{1}', group or '')
+
+
+@functools.lru_cache ()
+def load (filename = DEFAULT_FILE):
+    """ Load and compile the rules. """
+
+    with open (filename, 'rb') as fp:
+        data = fp.read ()
+    return TagRules (yaml.safe_load (data), hashlib.sha1 (data).hexdigest ())
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+"""The asynchronous geo API server for the Hikemap.
+
+Serves the /geo endpoints from an asyncio event loop, so one process can keep
+many geo requests in flight while waiting on PostGIS.  Tiles and info are still
+served by :mod:`server`.
+
+"""
+
+import argparse
+import logging
+import os.path
+
+from aiohttp import web
+
+import common
+from config import args, init_logging
+
+from db_tools import AsyncPostgreSQLEngine
+import geo_server
+
+
+def build_parser (default_config_file):
+    """ Build the commandline parser. """
+
+    parser = argparse.ArgumentParser (description = __doc__)
+
+    parser.add_argument (
+        '-v', '--verbose', dest='verbose', action='count',
+        help='increase output verbosity', default=0
+    )
+    parser.add_argument (
+        '-c', '--config-file', dest='config_file',
+        default=default_config_file, metavar='CONFIG_FILE',
+        help="the config file (default='%s')" % default_config_file
+    )
+    return parser
+
+
+def geojson_response (geojson):
+    return web.json_response (geojson, content_type = 'application/geo+json')
+
+
+async def altimetry (request):
+    try:
+        route_id = int (request.match_info['route_id'])
+    except ValueError:
+        raise web.HTTPNotFound ()
+    alternate = request.match_info.get ('alternate', '')
+
+    return geojson_response (
+        await geo_server.altimetry_async (request.app['dba'], route_id, alternate)
+    )
+
+
+async def routes_geojson (request):
+    route_type = request.match_info['route_type']
+    if route_type not in geo_server.MAP_IDS:
+        raise web.HTTPNotFound ()
+    if 'extent' not in request.query:
+        raise web.HTTPBadRequest ()
+
+    try:
+        return geojson_response (
+            await geo_server.routes_geojson_async (request.app['dba'], route_type, request.query['extent'])
+        )
+    except ValueError:
+        raise web.HTTPBadRequest ()
+
+
+async def extent_json (request):
+    return geojson_response (
+        await geo_server.extent_json_async (request.app['dba'], request.app['config']['GEO_EXTENT'])
+    )
+
+
+@web.middleware
+async def add_headers (request, handler):
+    response = await handler (request)
+    origin = request.headers.get ('Origin')
+    if origin and (origin == request.app['config']['CORS_ALLOW_ORIGIN'] or
+                   origin.startswith ('http://localhost')):
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type' # allow application/json
+    response.headers['Server'] = 'Jetty 0.8.15'
+    return response
+
+
+async def on_startup (app):
+    await app['dba'].open ()
+
+
+async def on_cleanup (app):
+    await app['dba'].close ()
+
+
+def create_app (conf):
+    app = web.Application (middlewares = [add_headers])
+
+    app['config'] = conf
+    app['dba']    = AsyncPostgreSQLEngine (**conf)
+
+    for l in conf['GEO_LAYERS']:
+        geo_server.MAP_IDS[l['id']] = l
+
+    app.add_routes ([
+        web.get ('/geo/altimetry/{route_id}/',            altimetry),
+        web.get ('/geo/altimetry/{route_id}/{alternate}', altimetry),
+        web.get ('/geo/routes/{route_type}.json',         routes_geojson),
+        web.get ('/geo/extent.json',                      extent_json),
+    ])
+
+    app.on_startup.append (on_startup)
+    app.on_cleanup.append (on_cleanup)
+
+    return app
+
+
+if __name__ == "__main__":
+    build_parser ('server.conf').parse_args (namespace = args)
+    init_logging (
+        args,
+        logging.StreamHandler (),
+        logging.FileHandler ('async_server.log')
+    )
+
+    conf = common.config_from_pyfile (os.path.join (os.path.dirname (__file__), args.config_file))
+    app = create_app (conf)
+
+    logging.getLogger ().info ("Mounted {name} geo API at {host}:{port} from conf {conf}".format (
+        name = conf['APPLICATION_NAME'],
+        host = conf['APPLICATION_HOST'],
+        port = conf['ASYNC_APPLICATION_PORT'],
+        conf = args.config_file
+    ))
+
+    web.run_app (app, host = conf['APPLICATION_HOST'], port = conf['ASYNC_APPLICATION_PORT'])
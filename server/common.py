@@ -21,8 +21,8 @@ def make_json_response (json = None, status = 200):
     })
 
 
-def make_geojson_response (rows, fields, geometry_field_name = 'geom', id_field_name = 'geo_id'):
-    """Make a geoJSON response.
+def make_geojson (rows, fields, geometry_field_name = 'geom', id_field_name = 'geo_id'):
+    """Make a geoJSON feature collection.
 
     All fields except the id and geometry fields become properties.
 
@@ -46,10 +46,18 @@ def make_geojson_response (rows, fields, geometry_field_name = 'geom', id_field_
         del properties[id_field_name]
         features.append (feature)
 
-    response = flask.make_response (flask.json.jsonify ({
+    return {
         'type'     : 'FeatureCollection',
         'features' : features,
-    }), 200, {
+    }
+
+
+def make_geojson_response (rows, fields, geometry_field_name = 'geom', id_field_name = 'geo_id'):
+    """ Make a geoJSON response. See :func:`make_geojson`. """
+
+    response = flask.make_response (flask.json.jsonify (
+        make_geojson (rows, fields, geometry_field_name, id_field_name)
+    ), 200, {
         'Content-Type' : 'application/geo+json;charset=utf-8',
     })
     return response
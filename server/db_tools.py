@@ -2,18 +2,28 @@
 
 """ This module contains helper functions for database access, config and logging. """
 
+import bisect
 import collections
 import configparser
 import datetime
 import io
+import itertools
+import json
 import logging
 import os
 import os.path
+import threading
+import time
 import types
 
 import sqlalchemy
 from sqlalchemy.sql import text
 
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
 COLORS = {
     logging.CRITICAL : ('\x1B[38;2;255;0;0m', '\x1B[0m'),
     logging.ERROR    : ('\x1B[38;2;255;0;0m', '\x1B[0m'),
@@ -54,27 +64,179 @@ MYSQL_DEFAULT_FILES  = ( '/etc/my.cnf', '/etc/mysql/my.cnf', '~/.my.cnf' )
 MYSQL_DEFAULT_GROUPS = ( 'mysql', 'client', 'client-server', 'client-mariadb' )
 
 
-def execute (conn, sql, parameters, debug_level = logging.DEBUG):
+HISTOGRAM_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+""" Upper bounds of the query latency histogram buckets in seconds. """
+
+
+class QueryStats ():
+    """Query latency histograms by statement name.
+
+    Statements slower than :attr:`slow_query_threshold` seconds are logged
+    together with their EXPLAIN (ANALYZE, BUFFERS) plan.
+
+    """
+
+    def __init__ (self, buckets = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.slow_query_threshold = None
+        self.lock    = threading.Lock ()
+        self.stats   = dict ()
+
+    def record (self, name, seconds):
+        with self.lock:
+            stats = self.stats.get (name)
+            if stats is None:
+                stats = self.stats[name] = {
+                    'count'     : 0,
+                    'total'     : 0.0,
+                    'max'       : 0.0,
+                    'slow'      : 0,
+                    'histogram' : [0] * (len (self.buckets) + 1),
+                }
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max']    = max (stats['max'], seconds)
+            stats['histogram'][bisect.bisect_left (self.buckets, seconds)] += 1
+            if self.is_slow (seconds):
+                stats['slow'] += 1
+
+    def is_slow (self, seconds):
+        return self.slow_query_threshold is not None and seconds > self.slow_query_threshold
+
+    def as_dict (self):
+        """ Return a snapshot of the stats suitable for a JSON response. """
+
+        with self.lock:
+            return {
+                'buckets'              : list (self.buckets),
+                'slow_query_threshold' : self.slow_query_threshold,
+                'queries'              : dict ([
+                    (name, dict (stats, histogram = list (stats['histogram']),
+                                  mean = stats['total'] / stats['count']))
+                    for name, stats in self.stats.items ()
+                ]),
+            }
+
+    def reset (self):
+        with self.lock:
+            self.stats.clear ()
+
+
+query_stats = QueryStats ()
+""" The global query stats, exposed by the info server. """
+
+
+def statement_name (sql):
+    """ Make a name for an untagged statement. """
+
+    return ' '.join (sql.split ())[:60]
+
+
+def explain (conn, sql, parameters, raw = False):
+    """Return the EXPLAIN (ANALYZE, BUFFERS) plan of a statement.
+
+    ANALYZE really runs the statement, so it always runs in a savepoint, or
+    outside a transaction in a transaction, that gets rolled back.  Statements
+    with side effects are not applied twice, whatever their kind.
+
+    """
+
+    sql = 'EXPLAIN (ANALYZE, BUFFERS) ' + sql
+    trans = conn.begin_nested () if conn.in_transaction () else conn.begin ()
+    try:
+        rows = conn.execute (sql if raw else text (sql), parameters).fetchall ()
+    finally:
+        trans.rollback ()
+    return '\n'.join ([row[0] for row in rows])
+
+
+def instrument (conn, name, start_time, result, sql, parameters, raw, debug_level):
+    """Record the statement timing and log slow statements with their plan.
+
+    The time is taken when the statement returns.  The engines of
+    :class:`PostgreSQLEngine` run SELECTs in server side cursors, where the
+    rows are computed while they are fetched, after this.  So for those the
+    stats cover only the opening of the cursor, and a slow SELECT may not be
+    logged as slow.  Time those with :func:`execute_prepared`, EXECUTE does not
+    go through a server side cursor.
+
+    """
+
+    seconds = time.perf_counter () - start_time
+    query_stats.record (name, seconds)
+
+    # with server side cursors rowcount is -1 until the rows are fetched
+    if result.rowcount >= 0:
+        log (debug_level, '%s: %d rows in %.3fs', name, result.rowcount, seconds)
+    else:
+        log (debug_level, '%s: %.3fs', name, seconds)
+
+    if query_stats.is_slow (seconds):
+        try:
+            plan = explain (conn, sql, parameters, raw)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            plan = str (e)
+        log (logging.WARNING, 'slow query %s: %.3fs\n%s\n%s', name, seconds, sql, plan)
+
+
+def execute (conn, sql, parameters, debug_level = logging.DEBUG, name = None):
     sql = sql.strip ().format (**parameters)
-    start_time = datetime.datetime.now ()
+    start_time = time.perf_counter ()
     result = conn.execute (text (sql), parameters)
-    log (debug_level, '%d rows in %.3fs', result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
+    instrument (conn, name or statement_name (sql), start_time, result, sql, parameters, False, debug_level)
+    return result
+
+
+PREPARED_STATEMENTS = collections.OrderedDict ()
+""" Statements to prepare server-side on every pooled connection. """
+
+
+def prepare (name, types, sql):
+    """Register a statement to be prepared on every connection.
+
+    The statement uses the positional parameters $1, $2, ... with the given
+    types.  The statement gets prepared the first time a connection that does
+    not know it yet is checked out of the pool, see
+    :meth:`PostgreSQLEngine.on_checkout`.
+
+    """
+
+    PREPARED_STATEMENTS[name] = (tuple (types), sql.strip ())
+
+
+def execute_prepared (conn, name, parameters, debug_level = logging.DEBUG):
+    """ Execute a statement registered with :func:`prepare`.
+
+    The parameters are given as a sequence in the order of $1, $2, ...  The
+    statement name is also used to tag the timing stats.
+
+    """
+
+    binds = dict ([('p%d' % i, p) for i, p in enumerate (parameters)])
+    sql = 'EXECUTE {name} ({params})'.format (
+        name = name, params = ', '.join ([':' + b for b in binds]))
+    start_time = time.perf_counter ()
+    result = conn.execute (text (sql), binds)
+    instrument (conn, name, start_time, result, sql, binds, False, debug_level)
     return result
 
 
-def executemany (conn, sql, parameters, param_array, debug_level = logging.DEBUG):
+def executemany (conn, sql, parameters, param_array, debug_level = logging.DEBUG, name = None):
     sql = sql.strip ().format (**parameters)
-    start_time = datetime.datetime.now ()
+    start_time = time.perf_counter ()
     result = conn.execute (text (sql), param_array)
-    log (debug_level, '%d rows in %.3fs', result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
+    # explain with the first parameter set only
+    instrument (conn, name or statement_name (sql), start_time, result, sql,
+                param_array[0] if param_array else {}, False, debug_level)
     return result
 
 
-def executemany_raw (conn, sql, parameters, param_array, debug_level = logging.DEBUG):
+def executemany_raw (conn, sql, parameters, param_array, debug_level = logging.DEBUG, name = None):
     sql = sql.strip ().format (**parameters)
-    start_time = datetime.datetime.now ()
+    start_time = time.perf_counter ()
     result = conn.execute (sql, param_array)
-    log (debug_level, '%d rows in %.3fs', result.rowcount, (datetime.datetime.now () - start_time).total_seconds ())
+    instrument (conn, name or statement_name (sql), start_time, result, sql,
+                param_array[0] if param_array else {}, True, debug_level)
     return result
 
 
@@ -85,72 +247,93 @@ def rollback (conn, debug_level = logging.DEBUG):
     return result
 
 
-def _debug (conn, msg, sql, parameters, level):
+TABULATE_SAMPLE = 100
+""" No. of rows used to calculate the column widths. """
+
+TABULATE_LIMIT = 1000
+""" Max. no. of rows to output. """
+
+
+def _debug (conn, msg, sql, parameters, level, out = None):
     # print values
-    if logging.getLogger ().getLevel () <= level:
+    if logger.isEnabledFor (level):
         result = execute (conn, sql, parameters)
-        if result.rowcount > 0:
-            log (level, msg + '\n' + tabulate (result))
+        lines = tabulate_lines (result, skip_empty = True)
+        first = next (lines, None)
+        if first is not None:
+            log (level, msg)
+            for line in itertools.chain ([first], lines):
+                if out is None:
+                    log (level, line)
+                else:
+                    out.write (line + '\n')
 
-def debug (conn, msg, sql, parameters):
-    _debug (conn, msg, sql, parameters, logging.DEBUG)
+def debug (conn, msg, sql, parameters, out = None):
+    _debug (conn, msg, sql, parameters, logging.DEBUG, out)
 
-def warn (conn, msg, sql, parameters):
-    _debug (conn, msg, sql, parameters, logging.WARNING)
+def warn (conn, msg, sql, parameters, out = None):
+    _debug (conn, msg, sql, parameters, logging.WARNING, out)
 
 
-def tabulate (res):
-    """ Format and output a rowset
+def tabulate_lines (res, sample = TABULATE_SAMPLE, limit = TABULATE_LIMIT, skip_empty = False):
+    """ Format a rowset, yielding one line at a time.
 
     Uses an output format similar to the one produced by the mysql commandline
     utility.
 
+    Only the first `sample` rows are held in memory to calculate the column
+    widths.  Longer values in later rows get truncated.  At most `limit` rows
+    are output (None for no limit), the rest are only counted.
+
     """
-    cols = range (0, len (res.keys ()))
-    rowlen = dict()
-    a = []
-
-    def line ():
-        for i in cols:
-            a.append ('+')
-            a.append ('-' * (rowlen[i] + 2))
-        a.append ('+\n')
-
-    # convert database types to strings
-    rows = []
-    for row in res.fetchall():
-        newrow = []
-        for i in cols:
-            if row[i] is None:
-                newrow.append ('NULL')
-            else:
-                newrow.append (str (row[i]))
-        rows.append (newrow)
-
-    # calculate column widths
-    for i in cols:
-        rowlen[i] = len (res.keys ()[i])
-
-    for row in rows:
-        for i in cols:
-            rowlen[i] = max (rowlen[i], len (row[i]))
+
+    keys = list (res.keys ())
+    head = res.fetchmany (sample)
+    if skip_empty and not head:
+        return
+
+    def cells (row):
+        return [ 'NULL' if v is None else str (v) for v in row ]
+
+    widths = [ len (k) for k in keys ]
+    for row in head:
+        widths = [ max (w, len (c)) for w, c in zip (widths, cells (row)) ]
+
+    line = '+' + '+'.join ([ '-' * (w + 2) for w in widths ]) + '+'
+    fmt  = '| ' + ' | '.join ([ '{:<%d.%d}' % (w, w) for w in widths ]) + ' |'
 
     # output header
-    line ()
-    for i in cols:
-        a.append ('| {:<{align}} '.format (res.keys ()[i], align = rowlen[i]))
-    a.append ('|\n')
-    line ()
+    yield line
+    yield fmt.format (*keys)
+    yield line
 
     # output rows
-    for row in rows:
-        for i in cols:
-            a.append ('| {:<{align}} '.format (row[i], align = rowlen[i]))
-        a.append ('|\n')
-    line ()
-    a.append ('%d rows\n' % len (rows))
+    n = 0
+    for row in itertools.chain (head, res):
+        if limit is None or n < limit:
+            yield fmt.format (*cells (row))
+        n += 1
+    yield line
+
+    if limit is not None and n > limit:
+        yield '%d rows (%d not shown)' % (n, n - limit)
+    else:
+        yield '%d rows' % n
+
+
+def tabulate (res, out = None, **kwargs):
+    """ Format and output a rowset
+
+    Writes the lines to the file `out` or, if `out` is None, returns them as
+    string.  See :func:`tabulate_lines` for the other parameters.
+
+    """
 
-    return ''.join (a)
+    lines = tabulate_lines (res, **kwargs)
+    if out is None:
+        return ''.join ([l + '\n' for l in lines])
+    for l in lines:
+        out.write (l + '\n')
 
 
 class MySQLEngine ():
@@ -220,16 +403,40 @@ class MySQLEngine ():
 class PostgreSQLEngine ():
     """ PostgreSQL Database Interface """
 
+    POOL_DEFAULTS = {
+        'PG_POOL_SIZE'     : 5,
+        'PG_MAX_OVERFLOW'  : 10,
+        'PG_POOL_PRE_PING' : False,
+        'PG_POOL_RECYCLE'  : -1,
+    }
+    """ Connection pool settings, may be overridden in :file:`server.conf`. """
+
     @staticmethod
     def on_checkout (dbapi_connection, connection_record, connection_proxy):
-        """Whenever a new connection is checkd out of the pool. """
+        """Whenever a connection is checked out of the pool.
+
+        Prepare all registered statements this connection does not know yet.
+        The info dict lives as long as the DBAPI connection, so each statement
+        gets prepared only once per server session.
 
-        # dbapi_connection.cursor ().execute (" ... ")
-        pass
+        """
+
+        prepared = connection_record.info.setdefault ('prepared', set ())
+        missing = [ name for name in PREPARED_STATEMENTS if name not in prepared ]
+        if missing:
+            cursor = dbapi_connection.cursor ()
+            for name in missing:
+                types, sql = PREPARED_STATEMENTS[name]
+                cursor.execute ('PREPARE {name} ({types}) AS {sql}'.format (
+                    name = name, types = ', '.join (types), sql = sql))
+                prepared.add (name)
+            cursor.close ()
+            dbapi_connection.commit ()
 
     def __init__ (self, **kwargs):
 
         args = self.get_connection_params (kwargs)
+        pool = dict ([(k, kwargs.get (k, v)) for k, v in self.POOL_DEFAULTS.items ()])
 
         self.url = 'postgresql+psycopg2://{user}@{host}:{port}/{database}?server_side_cursors'.format (**args)
 
@@ -237,11 +444,17 @@ class PostgreSQLEngine ():
 
         self.engine = sqlalchemy.create_engine (
             self.url,
-            use_batch_mode = True
+            use_batch_mode = True,
+            pool_size      = pool['PG_POOL_SIZE'],
+            max_overflow   = pool['PG_MAX_OVERFLOW'],
+            pool_pre_ping  = pool['PG_POOL_PRE_PING'],
+            pool_recycle   = pool['PG_POOL_RECYCLE'],
         )
 
         self.params = args
 
+        query_stats.slow_query_threshold = kwargs.get ('SLOW_QUERY_THRESHOLD')
+
         sqlalchemy.event.listen (self.engine, 'checkout', self.on_checkout)
 
 
@@ -286,3 +499,74 @@ class PostgreSQLEngine ():
         connection.set_isolation_level (0)
         connection.cursor ().execute ("VACUUM FULL ANALYZE")
         log (logging.INFO, ''.join (connection.notices))
+
+
+class AsyncPostgreSQLEngine ():
+    """Asynchronous PostgreSQL Database Interface
+
+    An asyncpg connection pool that runs the statements registered with
+    :func:`prepare`.  asyncpg prepares and caches statements on each
+    connection by itself, so we just hand it the SQL text.
+
+    Call :meth:`open` from inside the event loop before use.
+
+    """
+
+    def __init__ (self, **kwargs):
+        if asyncpg is None:
+            raise ImportError ('AsyncPostgreSQLEngine needs asyncpg')
+
+        self.params = PostgreSQLEngine.get_connection_params (self, kwargs)
+        pool = dict ([(k, kwargs.get (k, v)) for k, v in PostgreSQLEngine.POOL_DEFAULTS.items ()])
+
+        self.min_size = pool['PG_POOL_SIZE']
+        self.max_size = pool['PG_POOL_SIZE'] + pool['PG_MAX_OVERFLOW']
+        self.pool     = None
+
+        query_stats.slow_query_threshold = kwargs.get ('SLOW_QUERY_THRESHOLD')
+
+
+    @staticmethod
+    async def on_connect (conn):
+        """ Whenever the pool opens a new connection. """
+
+        await conn.set_type_codec ('json', encoder = json.dumps, decoder = json.loads, schema = 'pg_catalog')
+        await conn.set_builtin_type_codec ('hstore', codec_name = 'pg_contrib.hstore')
+
+
+    async def open (self):
+        log (logging.DEBUG, "AsyncPostgreSQLEngine: Connecting to {user}@{host}:{port}/{database}".format (**self.params))
+
+        self.pool = await asyncpg.create_pool (
+            host     = self.params['host'],
+            port     = int (self.params['port']),
+            user     = self.params['user'],
+            database = self.params['database'],
+            min_size = self.min_size,
+            max_size = self.max_size,
+            init     = self.on_connect,
+        )
+
+
+    async def close (self):
+        await self.pool.close ()
+
+
+    async def fetch (self, name, parameters, debug_level = logging.DEBUG):
+        """ Run a statement registered with :func:`prepare` and return all rows. """
+
+        dummy_types, sql = PREPARED_STATEMENTS[name]
+        async with self.pool.acquire () as conn:
+            start_time = time.perf_counter ()
+            rows = await conn.fetch (sql, *parameters)
+            seconds = time.perf_counter () - start_time
+
+            query_stats.record (name, seconds)
+            log (debug_level, '%s: %d rows in %.3fs', name, len (rows), seconds)
+
+            if query_stats.is_slow (seconds):
+                plan = await conn.fetch ('EXPLAIN (ANALYZE, BUFFERS) ' + sql, *parameters)
+                plan = '\n'.join ([row[0] for row in plan])
+                log (logging.WARNING, 'slow query %s: %.3fs\n%s\n%s', name, seconds, sql, plan)
+
+        return rows
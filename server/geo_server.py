@@ -7,7 +7,8 @@ from flask import abort, current_app, request, Blueprint
 from werkzeug.routing import BaseConverter
 
 import common
-from db_tools import execute
+import db_tools
+from db_tools import execute_prepared
 
 class Config (object):
     pass
@@ -35,20 +36,73 @@ class geoBlueprint (Blueprint):
 geo_app  = geoBlueprint ('geo',  __name__)
 
 def make_bbox (extent):
+    """ Parse an extent 'xmin,ymin,xmax,ymax' into a list of 4 floats. """
+
     ex = [float (x) for x in extent.split (',')]
-    return "ST_MakeEnvelope ({ex[0]},{ex[1]},{ex[2]},{ex[3]}, 4326)".format (ex = ex)
+    if len (ex) != 4:
+        raise ValueError ('extent must have 4 coordinates')
+    return ex
 
 
-def init_query_params (conn, **kw):
-    try:
-        params = dict (kw)
-        if 'extent' in request.args:
-            params['bbox'] = make_bbox (request.args.get ('extent'))
+def get_bbox ():
+    """ Get the bbox from the request or abort. """
 
-    except ValueError:
+    try:
+        return make_bbox (request.args['extent'])
+    except (KeyError, ValueError):
         abort (400)
 
-    return params
+
+def route_types (route_type):
+    """ Return the OSM route types to query for a geo layer. """
+
+    if route_type == 'hiking':
+        return [route_type, 'foot']
+    return [route_type]
+
+
+db_tools.prepare ('geo_altimetry', ('bigint', 'text'), """
+SELECT ST_AsGeoJSON (ST_Collect (linestringz ORDER BY sequence_id), 6)::json AS geom,
+       rel_id || '/' || member_role AS geo_id,
+       member_role,
+       rel_tags AS tags
+FROM ways_in_routes w
+WHERE rel_id = $1 AND member_role = $2 AND exist (way_tags, 'highway')
+GROUP BY rel_id, rel_tags, member_role
+
+UNION ALL
+
+SELECT ST_AsGeoJSON (linestringz, 6)::json AS geom,
+       way_id || '/' || member_role AS geo_id,
+       member_role,
+       way_tags AS tags
+FROM ways_in_routes w
+WHERE rel_id = $1 AND member_role = $2 AND NOT exist (way_tags, 'highway')
+
+UNION ALL
+
+SELECT ST_AsGeoJSON (geomz, 6)::json AS geom,
+       node_id || '/' || member_role AS geo_id,
+       member_role,
+       node_tags AS tags
+FROM pois_in_routes w
+WHERE rel_id = $1 AND member_role = $2
+""")
+
+db_tools.prepare ('geo_routes', ('float8', 'float8', 'float8', 'float8', 'text[]'), """
+SELECT NULL as geom,
+       rel_id || '/' || member_role AS geo_id,
+       member_role,
+       rel_tags AS tags
+FROM ways_in_routes w
+WHERE linestring && ST_MakeEnvelope ($1, $2, $3, $4, 4326)
+  AND rel_tags->'route' = ANY ($5)
+GROUP BY rel_id, rel_tags, member_role
+""")
+
+db_tools.prepare ('geo_extent', ('float8', 'float8', 'float8', 'float8'), """
+SELECT ST_AsGeoJSON (ST_MakeEnvelope ($1, $2, $3, $4, 4326))::json AS geom, 1 as geo_id
+""")
 
 
 @geo_app.route ('/altimetry/<int:route_id>/')
@@ -60,34 +114,7 @@ def altimetry (route_id, alternate = ''):
     """
 
     with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, """
-        SELECT ST_AsGeoJSON (ST_Collect (linestringz ORDER BY sequence_id), 6)::json AS geom,
-               rel_id || '/' || member_role AS geo_id,
-               member_role,
-               rel_tags AS tags
-        FROM ways_in_routes w
-        WHERE rel_id = :relation_id AND member_role = :alt AND exist (way_tags, 'highway')
-        GROUP BY rel_id, rel_tags, member_role
-
-        UNION ALL
-
-        SELECT ST_AsGeoJSON (linestringz, 6)::json AS geom,
-               way_id || '/' || member_role AS geo_id,
-               member_role,
-               way_tags AS tags
-        FROM ways_in_routes w
-        WHERE rel_id = :relation_id AND member_role = :alt AND NOT exist (way_tags, 'highway')
-
-        UNION ALL
-
-        SELECT ST_AsGeoJSON (geomz, 6)::json AS geom,
-               node_id || '/' || member_role AS geo_id,
-               member_role,
-               node_tags AS tags
-        FROM pois_in_routes w
-        WHERE rel_id = :relation_id AND member_role = :alt
-
-        """, init_query_params (conn, relation_id = route_id, alt = alternate))
+        res = execute_prepared (conn, 'geo_altimetry', (route_id, alternate))
 
         return common.make_geojson_response (
             res, 'geom, geo_id, member_role, tags'
@@ -99,22 +126,10 @@ def routes_geojson (route_type):
     """ Return all routes that intersect the bounding box.
     """
 
-    if route_type == 'hiking':
-        route_type = (route_type, 'foot')
-    else:
-        route_type = (route_type, )
+    bbox = get_bbox ()
 
     with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, """
-        SELECT NULL as geom,
-               rel_id || '/' || member_role AS geo_id,
-               member_role,
-               rel_tags AS tags
-        FROM ways_in_routes w
-        WHERE linestring && {bbox}
-          AND rel_tags->'route' IN :route_type
-        GROUP BY rel_id, rel_tags, member_role
-        """, init_query_params (conn, route_type = route_type))
+        res = execute_prepared (conn, 'geo_routes', bbox + [route_types (route_type)])
 
         return common.make_geojson_response (
             res, 'geom, geo_id, member_role, tags'
@@ -126,8 +141,34 @@ def extent_json ():
     """ Return the max. extent of all data points in latlng. """
 
     with current_app.config.dba.engine.begin () as conn:
-        res = execute (conn, """
-        SELECT ST_AsGeoJSON ({bbox})::json AS geom, 1 as geo_id
-        """, { 'bbox' : make_bbox (current_app.config['GEO_EXTENT']) })
+        res = execute_prepared (conn, 'geo_extent', make_bbox (current_app.config['GEO_EXTENT']))
 
         return common.make_geojson_response (res, 'geom, geo_id')
+
+
+# The async versions of the endpoints.  These run the same statements through
+# an :class:`db_tools.AsyncPostgreSQLEngine` and return GeoJSON dicts, see
+# :mod:`async_server`.
+
+async def altimetry_async (dba, route_id, alternate = ''):
+    """ Return route altimetry and POIs. """
+
+    rows = await dba.fetch ('geo_altimetry', (route_id, alternate))
+    return common.make_geojson (rows, 'geom, geo_id, member_role, tags')
+
+
+async def routes_geojson_async (dba, route_type, extent):
+    """ Return all routes that intersect the bounding box.
+
+    Raises ValueError if the extent is malformed.
+    """
+
+    rows = await dba.fetch ('geo_routes', make_bbox (extent) + [route_types (route_type)])
+    return common.make_geojson (rows, 'geom, geo_id, member_role, tags')
+
+
+async def extent_json_async (dba, extent):
+    """ Return the max. extent of all data points in latlng. """
+
+    rows = await dba.fetch ('geo_extent', make_bbox (extent))
+    return common.make_geojson (rows, 'geom, geo_id')
@@ -10,6 +10,7 @@ Serve general information about this service.
 from flask import current_app, Blueprint
 
 import common
+import db_tools
 
 class Config (object):
     pass
@@ -37,3 +38,10 @@ def info_json ():
         'wms_layers'  : conf['WMS_LAYERS'],
     }
     return common.make_json_response (i, 200)
+
+
+@info_app.route ('/queries.json')
+def queries_json ():
+    """ Query stats endpoint: send latency histograms of the database queries. """
+
+    return common.make_json_response (db_tools.query_stats.as_dict (), 200)